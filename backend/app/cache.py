@@ -0,0 +1,302 @@
+"""
+Small shared cache / state store used across workers.
+
+Backend is chosen by CACHE_URL:
+    memory://                             per-process (default; fine for a single worker)
+    sqlite:////var/tmp/pathnova-cache.db  shared by all workers on one host
+    redis://localhost:6379/0              shared by all hosts (needs the `redis` package)
+
+Values are JSON-serialized in every backend, so compare_and_set compares JSON values
+and behaves the same everywhere.
+"""
+import os, json, time, sqlite3, threading
+from typing import Any, Dict, Optional, Tuple
+
+CACHE_URL = os.getenv("CACHE_URL", "memory://")
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, default=str)
+
+def _loads(raw: Optional[str]) -> Any:
+    return None if raw is None else json.loads(raw)
+
+
+class Cache:
+    """Interface; ttl is in seconds, None means no expiry."""
+
+    def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Atomically add to an integer counter; ttl only applies when the key is created."""
+        raise NotImplementedError
+
+    def compare_and_set(self, key: str, expected: Any, value: Any, ttl: Optional[float] = None) -> bool:
+        """Atomically set key to value if its current value equals expected (None = absent)."""
+        raise NotImplementedError
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """Set only if the key does not exist yet."""
+        return self.compare_and_set(key, None, value, ttl)
+
+    def delete_if(self, key: str, expected: Any) -> bool:
+        """Atomically delete key if its current value equals expected."""
+        raise NotImplementedError
+
+
+class MemoryCache(Cache):
+    def __init__(self, max_entries: int = 100_000):
+        self._lock = threading.Lock()
+        self._data: Dict[str, Tuple[str, Optional[float]]] = {}
+        self.max_entries = max_entries
+
+    def _get_raw(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        raw, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return raw
+
+    def _set_raw(self, key: str, raw: str, ttl: Optional[float]):
+        if len(self._data) >= self.max_entries and key not in self._data:
+            now = time.monotonic()
+            for k in [k for k, (_, exp) in self._data.items() if exp is not None and exp <= now]:
+                del self._data[k]
+            if len(self._data) >= self.max_entries:
+                # drop the oldest insert
+                del self._data[next(iter(self._data))]
+        self._data[key] = (raw, time.monotonic() + ttl if ttl else None)
+
+    def get(self, key):
+        with self._lock:
+            return _loads(self._get_raw(key))
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set_raw(key, _dumps(value), ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, amount=1, ttl=None):
+        with self._lock:
+            raw = self._get_raw(key)
+            if raw is None:
+                value = amount
+                self._set_raw(key, _dumps(value), ttl)
+            else:
+                value = json.loads(raw) + amount
+                self._data[key] = (_dumps(value), self._data[key][1])
+            return value
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        with self._lock:
+            raw = self._get_raw(key)
+            if (raw is None) != (expected is None) or (raw is not None and raw != _dumps(expected)):
+                return False
+            self._set_raw(key, _dumps(value), ttl)
+            return True
+
+    def delete_if(self, key, expected):
+        with self._lock:
+            raw = self._get_raw(key)
+            if raw is None or raw != _dumps(expected):
+                return False
+            del self._data[key]
+            return True
+
+
+class SQLiteCache(Cache):
+    """
+    File-backed cache shared by processes on one host. One connection per thread.
+    Expired rows are deleted when read, and in bulk at most every purge_interval
+    seconds on writes, so keys that are never read again do not pile up.
+    """
+
+    def __init__(self, path: str, purge_interval: float = 60.0):
+        self.path = path
+        self.purge_interval = purge_interval
+        self._next_purge = 0.0
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _expiry(ttl: Optional[float]) -> Optional[float]:
+        return time.time() + ttl if ttl else None
+
+    def _get_raw(self, conn, key: str) -> Optional[str]:
+        row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= time.time():
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            return None
+        return row[0]
+
+    def _put(self, conn, key: str, raw: str, expires_at: Optional[float]):
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                     (key, raw, expires_at))
+        if time.monotonic() >= self._next_purge:
+            self._next_purge = time.monotonic() + self.purge_interval
+            self.purge(conn)
+
+    def purge(self, conn=None) -> int:
+        """Delete every expired row; returns how many."""
+        conn = conn or self._conn()
+        return conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def get(self, key):
+        return _loads(self._get_raw(self._conn(), key))
+
+    def set(self, key, value, ttl=None):
+        self._put(self._conn(), key, _dumps(value), self._expiry(ttl))
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1, ttl=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            raw = self._get_raw(conn, key)
+            if raw is None:
+                value = amount
+                self._put(conn, key, _dumps(value), self._expiry(ttl))
+            else:
+                value = json.loads(raw) + amount
+                conn.execute("UPDATE cache SET value = ? WHERE key = ?", (_dumps(value), key))
+            conn.execute("COMMIT")
+            return value
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            raw = self._get_raw(conn, key)
+            ok = (raw is None) == (expected is None) and (raw is None or raw == _dumps(expected))
+            if ok:
+                self._put(conn, key, _dumps(value), self._expiry(ttl))
+            conn.execute("COMMIT")
+            return ok
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete_if(self, key, expected):
+        cur = self._conn().execute(
+            "DELETE FROM cache WHERE key = ? AND value = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, _dumps(expected), time.time()))
+        return cur.rowcount > 0
+
+
+_INCR_LUA = """
+local v = redis.call('INCRBY', KEYS[1], ARGV[1])
+if tonumber(ARGV[2]) > 0 and redis.call('PTTL', KEYS[1]) == -1 then
+  redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return v
+"""
+
+_CAS_LUA = """
+local cur = redis.call('GET', KEYS[1])
+if ARGV[1] == '0' then
+  if cur then return 0 end
+elseif cur ~= ARGV[2] then
+  return 0
+end
+if tonumber(ARGV[4]) > 0 then
+  redis.call('SET', KEYS[1], ARGV[3], 'PX', ARGV[4])
+else
+  redis.call('SET', KEYS[1], ARGV[3])
+end
+return 1
+"""
+
+_DELETE_IF_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class RedisCache(Cache):
+    """Any server speaking the Redis protocol (Redis, Valkey, KeyDB, ...)."""
+
+    def __init__(self, url: str):
+        import redis  # optional dependency, only needed for redis:// URLs
+        self._r = redis.Redis.from_url(url, decode_responses=True)
+        self._incr = self._r.register_script(_INCR_LUA)
+        self._cas = self._r.register_script(_CAS_LUA)
+        self._delete_if = self._r.register_script(_DELETE_IF_LUA)
+
+    @staticmethod
+    def _ms(ttl: Optional[float]) -> int:
+        return int(ttl * 1000) if ttl else 0
+
+    def get(self, key):
+        return _loads(self._r.get(key))
+
+    def set(self, key, value, ttl=None):
+        self._r.set(key, _dumps(value), px=self._ms(ttl) or None)
+
+    def delete(self, key):
+        self._r.delete(key)
+
+    def incr(self, key, amount=1, ttl=None):
+        return int(self._incr(keys=[key], args=[amount, self._ms(ttl)]))
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        has_expected = "0" if expected is None else "1"
+        exp = "" if expected is None else _dumps(expected)
+        return bool(self._cas(keys=[key], args=[has_expected, exp, _dumps(value), self._ms(ttl)]))
+
+    def delete_if(self, key, expected):
+        return bool(self._delete_if(keys=[key], args=[_dumps(expected)]))
+
+
+def cache_from_url(url: str) -> Cache:
+    if url.startswith("memory://"):
+        return MemoryCache()
+    if url.startswith("sqlite:///"):
+        return SQLiteCache(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url)
+    raise RuntimeError(f"Unsupported CACHE_URL: {url}")
+
+_cache: Optional[Cache] = None
+_cache_lock = threading.Lock()
+
+def get_cache() -> Cache:
+    """Process-wide cache built from CACHE_URL on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = cache_from_url(CACHE_URL)
+    return _cache
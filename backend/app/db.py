@@ -1,28 +1,177 @@
-import os
-from sqlalchemy import create_engine
+import os, time, threading
+from typing import Any, Dict, Iterable, Optional
+from fastapi import Request
+from sqlalchemy import create_engine, exc as sa_exc
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
+from .cache import get_cache
 
 load_dotenv()  # loads backend/.env
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL not set")
+# Optional read replica; read-only endpoints use it when set
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+# After a user writes, their reads go to the primary for this long (replica lag cover)
+READ_PIN_SECONDS = int(os.getenv("READ_PIN_SECONDS", "10"))
 
-# Engine
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,   
-    echo=True, 
-    future=True
-)
+SQL_ECHO = os.getenv("SQL_ECHO", "").lower() in ("1", "true", "yes")
+
+# Pool sizing, per engine and per worker process: size + overflow is the most
+# connections one worker opens, so keep workers * (size + overflow) under max_connections.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+# seconds to wait for a free connection before failing the request
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# connections older than this are replaced on checkout (before server/proxy idle timeouts)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# a ping round trip on every checkout; off by default, recycle + keepalives cover staleness
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "").lower() in ("1", "true", "yes")
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait and how often they time out."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.stats = {"checkouts": 0, "wait_total_ms": 0.0, "wait_max_ms": 0.0, "timeouts": 0}
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except sa_exc.TimeoutError:
+            with self._stats_lock:
+                self.stats["timeouts"] += 1
+            raise
+        finally:
+            # includes opening a new connection when the pool has room for one
+            waited = (time.perf_counter() - started) * 1000
+            with self._stats_lock:
+                self.stats["checkouts"] += 1
+                self.stats["wait_total_ms"] += waited
+                self.stats["wait_max_ms"] = max(self.stats["wait_max_ms"], waited)
+
+    def recreate(self):
+        # keep the counters when the pool is recreated (e.g. engine.dispose())
+        pool = super().recreate()
+        pool.stats, pool._stats_lock = self.stats, self._stats_lock
+        return pool
+
+def _make_engine(url: str, **kwargs):
+    connect_args = {}
+    if url.startswith("postgresql+psycopg2") or url.startswith("postgresql://"):
+        # let the OS notice dead peers instead of pinging on every checkout
+        connect_args = {"keepalives": 1, "keepalives_idle": 60,
+                        "keepalives_interval": 10, "keepalives_count": 3}
+    return create_engine(
+        url,
+        poolclass=TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        # reuse the most recent connection so surplus ones sit idle and get recycled
+        pool_use_lifo=True,
+        connect_args=connect_args,
+        echo=SQL_ECHO,
+        future=True,
+        **kwargs
+    )
+
+# Engines (no connection is opened until first use)
+engine = _make_engine(DATABASE_URL)
+read_engine = (_make_engine(DATABASE_READ_URL, execution_options={"postgresql_readonly": True})
+               if DATABASE_READ_URL else engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 Base = declarative_base()
 
+def release_connection(db):
+    """
+    End the session's transaction so its connection goes back to the pool, e.g. before
+    a slow external call. Loaded objects are expired; the session reconnects on next use.
+    """
+    db.commit()
+
+def pool_metrics() -> Dict[str, Any]:
+    """Pool occupancy and checkout wait stats for each engine in this process."""
+    out = {}
+    engines = {"primary": engine} if read_engine is engine else {"primary": engine, "replica": read_engine}
+    for name, eng in engines.items():
+        pool = eng.pool
+        with pool._stats_lock:
+            stats = dict(pool.stats)
+        if stats.get("checkouts"):
+            stats["wait_avg_ms"] = stats["wait_total_ms"] / stats["checkouts"]
+        out[name] = {
+            "size": pool.size(),
+            "max_overflow": DB_MAX_OVERFLOW,
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            # negative while the pool has not opened all of its base connections
+            "overflow": pool.overflow(),
+            **stats,
+        }
+    return out
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+
+# ---- read-your-writes ----
+# Pins live in the shared cache. With the default memory:// cache they only hold in the
+# worker that wrote, so multi-worker deployments with a replica need a shared CACHE_URL.
+def check_read_routing():
+    """Warn at startup when a replica is configured but read pins cannot cross workers."""
+    from .cache import CACHE_URL
+    if read_engine is not engine and READ_PIN_SECONDS > 0 and CACHE_URL.startswith("memory://"):
+        print("WARNING: DATABASE_READ_URL is set but CACHE_URL is memory://; read-your-writes "
+              "pins only hold within one worker. Set CACHE_URL to sqlite:/// or redis:// "
+              "when running more than one worker.")
+
+def pin_reads(*keys):
+    """Route reads for these user keys (user id / email) to the primary for READ_PIN_SECONDS."""
+    if read_engine is engine or READ_PIN_SECONDS <= 0:
+        return
+    cache = get_cache()
+    for k in keys:
+        if k:
+            cache.set(f"rw:pin:{str(k).strip().lower()}", 1, ttl=READ_PIN_SECONDS)
+
+def reads_pinned(keys: Iterable[Optional[str]]) -> bool:
+    cache = get_cache()
+    return any(cache.get(f"rw:pin:{str(k).strip().lower()}") for k in keys if k)
+
+def _request_user_keys(request: Request):
+    email = request.query_params.get("email")
+    if email:
+        yield email
+    session = request.cookies.get("session")
+    if session:
+        import jwt
+        try:
+            # routing only; require_user verifies the token
+            yield jwt.decode(session, options={"verify_signature": False}).get("uid")
+        except jwt.PyJWTError:
+            pass
+
+def get_read_db(request: Request):
+    """Session for read-only endpoints: the replica, unless this user wrote recently."""
+    if read_engine is engine or reads_pinned(_request_user_keys(request)):
+        db = SessionLocal()
+    else:
+        db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
@@ -1,5 +1,16 @@
+from sqlalchemy import inspect
 from .db import Base, engine
-from .models import Ping, User, TypeformResponse, LearningPlan
+from .models import Ping, User, TypeformResponse, LearningPlan, PlanTrace, CohortCount
 
 def init_db():
+    had_cohort_counts = inspect(engine).has_table(CohortCount.__tablename__)
     Base.metadata.create_all(bind=engine)
+    if not had_cohort_counts:
+        # counts are maintained incrementally from here on; start from existing submissions
+        from .services import cohort_stats
+        cohort_stats.rebuild()
+
+if __name__ == "__main__":
+    # python -m app.init_db
+    init_db()
+    print("schema created")
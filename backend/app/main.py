@@ -1,26 +1,34 @@
-import os, datetime as dt, uuid, urllib.parse as urlparse, httpx
-from fastapi import FastAPI, Depends, Request, HTTPException, Query, Body, Cookie, Response, BackgroundTasks
+import os, json, math, hashlib, datetime as dt, uuid, urllib.parse as urlparse
+from fastapi import FastAPI, Depends, Request, HTTPException, Query, Body, Cookie, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
-from .services.typeform_mapper import extract_response_fields
-from .services.plan_inputs import build_user_context, signature_for_context
-from .services.generate_plan import generate_plan_from_response, generate_learning_plan, OPENAI_MODEL
-from .db import get_db
+from fastapi.responses import RedirectResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from .services.typeform_mapper import extract_response_fields, extract_name_email_from_answers
+from .services.plan_inputs import build_user_context, context_from, signature_for_context
+from .services.generate_plan import submit_plan_job, plan_for_context, find_existing_plan, remember_plan
+from .services.plan_index import profile_index
+from .services.admission import Overloaded, check_user_rate
+from .services import plan_events, plan_trace, cohort_stats
+from .db import get_db, get_read_db, pin_reads, pool_metrics, check_read_routing
+from .cache import get_cache
 from .init_db import init_db
 from .schemas import GeneratePlanRequest, LearningPlanResponse, GoogleTokenIn
 from .models import Ping, TypeformResponse, User, LearningPlan, AuthProvider
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
-from google.oauth2 import id_token
-from google.auth.transport import requests as grequests
-from pydantic import BaseModel
-from typing import Optional, Tuple, Dict, List, Any
+from sqlalchemy.orm import Session
+from typing import Optional, Tuple, Dict, Any
 import jwt
 from dotenv import load_dotenv
 load_dotenv()
 
 app = FastAPI(title="PathNova API")
 TYPEFORM_SECRET = os.getenv("TYPEFORM_SECRET")
+# Schema is normally created out of band with `python -m app.init_db`
+AUTO_CREATE_SCHEMA = os.getenv("AUTO_CREATE_SCHEMA", "").lower() in ("1", "true", "yes")
+# Typeform retries deliveries; identical bodies within this window are acknowledged without reprocessing
+WEBHOOK_DEDUPE_TTL = int(os.getenv("WEBHOOK_DEDUPE_TTL", "86400"))
+# a delivery is only claimed this long while it is processed, so a killed worker does
+# not swallow the retries; it is extended to WEBHOOK_DEDUPE_TTL once committed
+WEBHOOK_CLAIM_TTL = int(os.getenv("WEBHOOK_CLAIM_TTL", "60"))
 
 # Allow React dev server
 app.add_middleware(
@@ -34,9 +42,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+    )
+
 @app.on_event("startup")
 def startup():
-    init_db()
+    check_read_routing()
+    if AUTO_CREATE_SCHEMA:
+        init_db()
 
 
 @app.get("/")
@@ -52,7 +70,7 @@ def create_ping(db: Session = Depends(get_db)):
     return {"id": row.id, "note": row.note}
 
 @app.get("/ping/{pid}")
-def read_ping(pid: int, db: Session = Depends(get_db)):
+def read_ping(pid: int, db: Session = Depends(get_read_db)):
     row = db.get(Ping, pid)
     return {"exists": bool(row), "row": {"id": row.id, "note": row.note} if row else None}
 
@@ -67,35 +85,11 @@ def verify_typeform_signature(payload: bytes, signature: str) -> bool:
     # return hmac.compare_digest(expected, provided)
     return True
 
-def normalize_email(email: Optional[str]) -> Optional[str]:
-    if not email: 
-        return None
-    e = email.strip().lower()
-    return e or None
-
-def extract_name_email_from_answers(answers: List[Dict[str, Any]]) -> Dict[str, Optional[str]]:
-    name = None
-    email = None
-
-    for a in answers or []:
-        t = a.get("type")
-
-        if t == "email":
-            val = a.get("email")
-            if val:
-                email = val.strip()
-
-        if t == "text":
-            txt = (a.get("text") or "").strip()
-            if txt and not name:
-                name = txt
-
-    return {"name": name, "email": normalize_email(email)}
-
 def get_or_create_user_by_email( db: Session, *, email: Optional[str], name: Optional[str]) -> Tuple[Optional[User], bool, bool]:
     """
     Upserts a user by email. Creates if not found. Updates name if changed.
-    Returns the User or None (if no email passed).
+    Returns (user or None if no email passed, created, name_changed). On a name change
+    the caller clears the cached session user after committing.
     """
     if not email:
         return None, False, False
@@ -116,13 +110,28 @@ def get_or_create_user_by_email( db: Session, *, email: Optional[str], name: Opt
     return user, True, False
 
 @app.post("/webhooks/typeform")
-async def typeform_webhook(request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+async def typeform_webhook(request: Request, db: Session = Depends(get_db)):
+    trace = plan_trace.Trace()
+    trace.mark("received")
     raw = await request.body()
     signature = request.headers.get("Typeform-Signature")
 
     if not verify_typeform_signature(raw, signature):
         raise HTTPException(status_code=401, detail="Invalid signature")
 
+    delivery_key = "webhook:" + hashlib.sha256(raw).hexdigest()
+    if not get_cache().add(delivery_key, 1, ttl=WEBHOOK_CLAIM_TTL):
+        return {"ok": True, "duplicate": True}
+    try:
+        result = await process_typeform_payload(request, db, trace)
+    except BaseException:
+        # includes cancellation; let Typeform's retry through
+        get_cache().delete(delivery_key)
+        raise
+    get_cache().set(delivery_key, 1, ttl=WEBHOOK_DEDUPE_TTL)
+    return result
+
+async def process_typeform_payload(request: Request, db: Session, trace: plan_trace.Trace):
     payload = await request.json()
     frm = payload.get("form_response", {}) or {}
     form_id = frm.get("form_id")
@@ -156,13 +165,22 @@ async def typeform_webhook(request: Request, background_tasks: BackgroundTasks,
     ).first()
 
     if resp:
-        if user and resp.user_id != user.id:
-            resp.user_id = user.id
-        # Update only columns that actually exist on the model
-        for k, v in (fields or {}).items():
-            if hasattr(TypeformResponse, k):
-                setattr(resp, k, v)
+        with cohort_stats.track(db, resp.user_id, user.id if user else None):
+            if user and resp.user_id != user.id:
+                resp.user_id = user.id
+            # last write wins for the raw answers too, so a backfill re-derives the same columns
+            resp.answers = answers
+            if form_id:
+                resp.form_id = form_id
+            # Update only columns that actually exist on the model
+            for k, v in (fields or {}).items():
+                if hasattr(TypeformResponse, k):
+                    setattr(resp, k, v)
         db.commit()
+        if updated:
+            forget_session_user(user.id)
+        pin_reads(resp.user_id, email)
+        profile_index.upsert(resp.user_id, fields)
         return {"ok": True, "updated": True, "submission_id": submission_id, "user_id": resp.user_id}
     
     # Create a new response row
@@ -178,15 +196,23 @@ async def typeform_webhook(request: Request, background_tasks: BackgroundTasks,
     }
 
     new_resp = TypeformResponse(**create_kwargs)
-    db.add(new_resp)
+    with cohort_stats.track(db, new_resp.user_id):
+        db.add(new_resp)
 
     # Commit persists user and response table
     db.commit()
+    if updated:
+        forget_session_user(user.id)
     db.refresh(new_resp)
+    trace.mark("persisted")
+    pin_reads(new_resp.user_id, email)
+    profile_index.upsert(new_resp.user_id, fields)
 
-    background_tasks.add_task(generate_plan_from_response, new_resp.id)
+    submit_plan_job(new_resp.id, trace=trace)
+    trace.mark("queued")
+    plan_events.publish(new_resp.user_id, "queued", response_id=new_resp.id, trace_id=trace.trace_id)
     print("PLAN JOB QUEUED FOR:", new_resp.id)
-    return {"ok": True, "created": True, "submission_id": submission_id}
+    return {"ok": True, "created": True, "submission_id": submission_id, "trace_id": str(trace.trace_id)}
 
 
 # =========LEARNING PLAN===============
@@ -203,39 +229,80 @@ def generate_plan(req: GeneratePlanRequest = Body(...), db: Session = Depends(ge
     # Create input signature to dedupe identical runs
     sig = signature_for_context(ctx)
     if not req.regenerate:
-        existing = (db.query(LearningPlan)
-                      .filter(LearningPlan.user_id == user_id,
-                              LearningPlan.input_signature == sig)
-                      .order_by(LearningPlan.created_at.desc())
-                      .first())
+        existing = find_existing_plan(db, user_id, sig)
         if existing:
             return LearningPlanResponse(
                 user_id=str(user_id),
-                model=existing.model,
-                plan=existing.plan
+                model=existing["model"],
+                plan=existing["plan"]
             )
 
-    # call openAI
-    plan = generate_learning_plan(ctx)
+    # per-user budget; the global LLM limiter applies inside generation
+    check_user_rate(user_id)
+
+    # reuse a near-identical user's plan or call openAI
+    plan, model = plan_for_context(db, user_id, ctx, allow_reuse=not req.regenerate)
 
     row = LearningPlan(
         user_id=user_id,
         input_signature=sig,
-        model=OPENAI_MODEL,
+        model=model,
         plan=plan
     )
     db.add(row)
     db.commit()
+    pin_reads(user_id, req.email)
+    remember_plan(user_id, sig, model, plan)
 
     return LearningPlanResponse(
         user_id=str(user_id),
-        model=OPENAI_MODEL,
+        model=model,
         plan=plan
     )
 
+def current_plan_status(db: Session, user: User) -> Dict[str, Any]:
+    """
+    "ready" when the user's latest submission already has a plan, "pending" when it
+    does not yet, "none" without a submission.
+    """
+    resp = (db.query(TypeformResponse)
+              .filter(TypeformResponse.user_id == user.id)
+              .order_by(TypeformResponse.received_at.desc())
+              .first())
+    if not resp:
+        return {"status": "none"}
+    sig = signature_for_context(context_from(user, resp))
+    status = "ready" if find_existing_plan(db, user.id, sig) else "pending"
+    return {"status": status, "response_id": resp.id}
+
+# Push plan status to the dashboard instead of polling /plan/latest
+@app.get("/plan/events")
+async def plan_events_stream(request: Request, session: str | None = Cookie(default=None)):
+    # authenticate with a short-lived session so no DB connection is held by the stream
+    def authenticate() -> User:
+        gen = get_read_db(request)
+        try:
+            return require_user(session, next(gen))
+        finally:
+            gen.close()
+
+    def snapshot() -> Dict[str, Any]:
+        gen = get_read_db(request)
+        try:
+            return current_plan_status(next(gen), current)
+        finally:
+            gen.close()
+
+    current = await run_in_threadpool(authenticate)
+    return StreamingResponse(
+        plan_events.event_stream(request, str(current.id), snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # Find the latest plan
 @app.get("/plan/latest", response_model=LearningPlanResponse)
-def latest(email: str = Query(...), db: Session = Depends(get_db)):
+def latest(email: str = Query(...), db: Session = Depends(get_read_db)):
     # find the user by email
     norm_email = email.strip().lower()
     user = db.query(User).filter(User.email == norm_email).first()
@@ -286,6 +353,9 @@ GOOGLE_CLIENT_ID = os.getenv("GOOGLE_OAUTH_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_OAUTH_CLIENT_SECRET")          
 GOOGLE_REDIRECT_URI = os.getenv("GOOGLE_OAUTH_REDIRECT_URI", "http://localhost:8000/auth/google/callback")
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:5173")
+SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", "300"))
+# comma-separated emails allowed to use /admin endpoints
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv("ADMIN_EMAILS", "").split(",") if e.strip()}
 
 def make_jwt(uid: str) -> str:
     payload = {
@@ -300,25 +370,39 @@ def read_jwt(token: str) -> str:
     data = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
     return data["uid"]
 
-def require_user(session: str | None = Cookie(default=None), db: Session = Depends(get_db)) -> User:
+def verify_google_id_token(token: str) -> Dict[str, Any]:
+    # google auth is imported lazily; it is slow to import and only needed at login
+    from google.oauth2 import id_token
+    from google.auth.transport import requests as grequests
+    return id_token.verify_oauth2_token(token, grequests.Request(), GOOGLE_CLIENT_ID)
+
+def require_user(session: str | None = Cookie(default=None), db: Session = Depends(get_read_db)) -> User:
     if not session:
         raise HTTPException(status_code=401, detail="No session")
     try:
         uid = read_jwt(session)
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid session")
+    # cached session user; a detached User carrying the id/email/name columns
+    key = f"session:user:{uid}"
+    cached = get_cache().get(key)
+    if cached:
+        return User(id=uuid.UUID(cached["id"]), email=cached["email"], name=cached["name"])
+
     user = db.get(User, uid)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
+    get_cache().set(key, {"id": str(user.id), "email": user.email, "name": user.name}, ttl=SESSION_CACHE_TTL)
     return user
 
+def forget_session_user(uid):
+    get_cache().delete(f"session:user:{uid}")
+
 @app.post("/auth/google")
 def auth_google(body: GoogleTokenIn, response: Response, db: Session = Depends(get_db)):
     # Verify Google ID token
     try:
-        claims = id_token.verify_oauth2_token(
-            body.id_token, grequests.Request(), GOOGLE_CLIENT_ID
-        )
+        claims = verify_google_id_token(body.id_token)
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid Google token")
 
@@ -328,6 +412,7 @@ def auth_google(body: GoogleTokenIn, response: Response, db: Session = Depends(g
     if not sub:
         raise HTTPException(status_code=400, detail="Missing Google sub")
 
+    renamed = False
     # Find existing mapping
     ap = db.query(AuthProvider).filter_by(provider="google", provider_user_id=sub).one_or_none()
 
@@ -349,6 +434,7 @@ def auth_google(body: GoogleTokenIn, response: Response, db: Session = Depends(g
         else:
             if name and user.name != name:
                 user.name = name
+                renamed = True
 
         ap = AuthProvider(
             provider="google",
@@ -359,6 +445,10 @@ def auth_google(body: GoogleTokenIn, response: Response, db: Session = Depends(g
         db.add(ap)
 
     db.commit()
+    if renamed:
+        # after the commit, so a concurrent require_user cannot re-cache the old name
+        forget_session_user(user.id)
+    pin_reads(user.id, email)
 
     # Set session cookie
     token = make_jwt(str(user.id))
@@ -378,6 +468,35 @@ def auth_google(body: GoogleTokenIn, response: Response, db: Session = Depends(g
 def auth_me(current: User = Depends(require_user)):
     return {"id": str(current.id), "email": current.email, "name": current.name}
 
+def require_admin(current: User = Depends(require_user)) -> User:
+    if (current.email or "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Admin only")
+    return current
+
+# Where the time goes between form submission and plan ready
+@app.get("/admin/plan-timings")
+def plan_timings(hours: float = Query(24.0, gt=0, le=24 * 90),
+                 admin: User = Depends(require_admin),
+                 db: Session = Depends(get_read_db)):
+    return plan_trace.stage_percentiles(db, hours=hours)
+
+# Connection pool occupancy and checkout waits for this worker
+@app.get("/admin/db-pool")
+def db_pool(admin: User = Depends(require_admin)):
+    return pool_metrics()
+
+# Distributions of profile answers across users, from the incrementally kept cohort_counts
+@app.get("/admin/cohorts")
+def cohorts(dimension: Optional[str] = Query(None), limit: int = Query(50, gt=0, le=1000),
+            admin: User = Depends(require_admin),
+            db: Session = Depends(get_read_db)):
+    if dimension is None:
+        return cohort_stats.distributions(db, limit=limit)
+    try:
+        return cohort_stats.distribution(db, dimension, limit=limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/auth/logout")
 def auth_logout(response: Response):
     # Clear cookie
@@ -401,6 +520,7 @@ def google_start():
 # Exchange code for tokens using Google's token endpoint
 @app.get("/auth/google/callback")
 async def google_callback(request: Request, response: Response, code: str, db: Session = Depends(get_db)):   
+    import httpx
     async with httpx.AsyncClient(timeout=10) as client:
         token_res = await client.post(
             "https://oauth2.googleapis.com/token",
@@ -423,7 +543,7 @@ async def google_callback(request: Request, response: Response, code: str, db: S
 
     # Verify the ID token with Google
     try:
-        claims = id_token.verify_oauth2_token(id_token_str, grequests.Request(), GOOGLE_CLIENT_ID)
+        claims = verify_google_id_token(id_token_str)
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid Google ID token")
 
@@ -434,6 +554,7 @@ async def google_callback(request: Request, response: Response, code: str, db: S
     if not sub:
         raise HTTPException(status_code=400, detail="Missing Google sub")
 
+    renamed = False
     # Upsert user & provider mapping
     ap = db.query(AuthProvider).filter_by(provider="google", provider_user_id=sub).one_or_none()
     if ap:
@@ -451,6 +572,7 @@ async def google_callback(request: Request, response: Response, code: str, db: S
         else:
             if name and user.name != name:
                 user.name = name
+                renamed = True
 
         ap = AuthProvider(
             provider="google",
@@ -461,6 +583,10 @@ async def google_callback(request: Request, response: Response, code: str, db: S
         db.add(ap)
 
     db.commit()
+    if renamed:
+        # after the commit, so a concurrent require_user cannot re-cache the old name
+        forget_session_user(user.id)
+    pin_reads(user.id, email)
 
     # Create session cookie
     token = make_jwt(str(user.id))
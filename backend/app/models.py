@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, TIMESTAMP, text, ForeignKey, UniqueConstraint, Text, DateTime, func
+from sqlalchemy import Column, Integer, String, TIMESTAMP, text, ForeignKey, UniqueConstraint, Text, DateTime, func, Index, BigInteger
 from sqlalchemy.dialects.postgresql import UUID, JSONB, ARRAY
 from .db import Base
 from sqlalchemy.orm import relationship
@@ -24,7 +24,8 @@ class TypeformResponse(Base):
     form_id = Column(String, nullable=False)
     submission_id = Column(String, unique=True) 
     answers = Column(JSONB, nullable=False)
-    received_at = Column(TIMESTAMP, server_default=text("now()"))
+    # indexed for incremental reads (plan index refresh)
+    received_at = Column(TIMESTAMP, server_default=text("now()"), index=True)
 
     # User profiles
     career_level = Column(String, nullable=True)
@@ -57,3 +58,31 @@ class AuthProvider(Base):
     last_login_at = Column(DateTime(timezone=True), server_default=func.now())
 
     user = relationship("User", back_populates="providers")
+
+class PlanTrace(Base):
+    """Stage timestamps for one submission, from webhook receipt to plan committed."""
+    __tablename__ = "plan_traces"
+    trace_id = Column(UUID(as_uuid=True), primary_key=True)
+    response_id = Column(UUID(as_uuid=True), nullable=True)
+    user_id = Column(UUID(as_uuid=True), nullable=True)
+    outcome = Column(String, nullable=True)
+    received_at = Column(DateTime(timezone=True))
+    persisted_at = Column(DateTime(timezone=True))
+    queued_at = Column(DateTime(timezone=True))
+    job_started_at = Column(DateTime(timezone=True))
+    context_built_at = Column(DateTime(timezone=True))
+    llm_started_at = Column(DateTime(timezone=True))
+    llm_finished_at = Column(DateTime(timezone=True))
+    plan_committed_at = Column(DateTime(timezone=True))
+
+    # jobs started outside the webhook have no received_at; window queries use this
+    __table_args__ = (Index("ix_plan_traces_started", func.coalesce(received_at, job_started_at)),)
+
+class CohortCount(Base):
+    """How many users' current submission has value in dimension (incrementally maintained)."""
+    __tablename__ = "cohort_counts"
+    dimension = Column(String, primary_key=True)
+    value = Column(String, primary_key=True)
+    count = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (Index("ix_cohort_counts_top", dimension, count.desc()),)
@@ -0,0 +1,215 @@
+"""
+Admission control for LLM-backed work.
+
+- llm_limiter: caps concurrent LLM calls in this process (LLM_MAX_CONCURRENCY, per
+  worker), with a bounded wait queue. Interactive callers that would exceed the
+  queue, or that wait longer than the timeout, get Overloaded immediately instead of
+  piling up. Background jobs pass bounded=False: they wait in their own FIFO however
+  long it takes, so no plan is dropped, and are only let in while no interactive
+  caller is waiting.
+- Across workers, each call also holds one of LLM_GLOBAL_MAX_CONCURRENCY leases in
+  the shared cache (the OpenAI limit is per organisation). Leases expire after
+  LLM_LEASE_TTL, so a killed worker's calls free up on their own. With the default
+  memory:// CACHE_URL the leases are per process too; use sqlite:// or redis:// when
+  running several workers.
+- take_user_token: per-user token bucket kept in the shared cache, so limits hold
+  across workers.
+
+Overloaded carries a retry_after; the API turns it into 429 + Retry-After.
+"""
+import os, time, uuid, random, threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+from ..cache import get_cache
+
+# per worker process
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+# across all workers sharing CACHE_URL (0 = no global cap)
+LLM_GLOBAL_MAX_CONCURRENCY = int(os.getenv("LLM_GLOBAL_MAX_CONCURRENCY", str(LLM_MAX_CONCURRENCY)))
+# longer than the slowest LLM call (the OpenAI client times out after 600s)
+LLM_LEASE_TTL = float(os.getenv("LLM_LEASE_TTL", "600"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "16"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "15"))
+# per-user bucket: burst size and refill rate (tokens per minute)
+LLM_USER_BURST = float(os.getenv("LLM_USER_BURST", "3"))
+LLM_USER_REFILL_PER_MIN = float(os.getenv("LLM_USER_REFILL_PER_MIN", "2"))
+
+
+class Overloaded(Exception):
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = max(1.0, retry_after)
+
+
+class GlobalLeases:
+    """
+    At most `limit` holders across every process sharing the cache. A holder owns one
+    of `limit` lease keys, claimed with add() and released with delete_if() on its
+    own token, so an expired and reclaimed lease is never freed by its old holder.
+    """
+
+    def __init__(self, name: str, limit: int, ttl: float):
+        self.name = name
+        self.limit = limit
+        self.ttl = ttl
+
+    def try_acquire(self) -> Optional[Tuple[str, str]]:
+        cache = get_cache()
+        token = uuid.uuid4().hex
+        start = random.randrange(self.limit)
+        for i in range(self.limit):
+            key = f"{self.name}:{(start + i) % self.limit}"
+            if cache.add(key, token, ttl=self.ttl):
+                return key, token
+        return None
+
+    def acquire(self, deadline: Optional[float], retry_after: Callable[[], float]) -> Tuple[str, str]:
+        """Poll for a lease until deadline (None = forever); Overloaded when it passes."""
+        delay = 0.05
+        while True:
+            lease = self.try_acquire()
+            if lease:
+                return lease
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise Overloaded("LLM capacity is in use by other workers", retry_after())
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def release(self, lease: Tuple[str, str]):
+        key, token = lease
+        try:
+            get_cache().delete_if(key, token)
+        except Exception as e:
+            # the lease expires on its own
+            print("llm leases: release failed:", e)
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_concurrent: int, max_waiting: int, wait_timeout: float,
+                 leases: Optional[GlobalLeases] = None):
+        self._cond = threading.Condition()
+        self.leases = leases
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.active = 0
+        self.waiting = 0
+        # unbounded (background) waiters in arrival order; not counted against max_waiting
+        self._background: deque = deque()
+        # moving average of how long a slot is held, used for Retry-After
+        self._avg_hold = 10.0
+
+    def configure(self, max_concurrent: Optional[int] = None, max_waiting: Optional[int] = None,
+                  wait_timeout: Optional[float] = None):
+        with self._cond:
+            if max_concurrent is not None:
+                self.max_concurrent = max_concurrent
+            if max_waiting is not None:
+                self.max_waiting = max_waiting
+            if wait_timeout is not None:
+                self.wait_timeout = wait_timeout
+            self._cond.notify_all()
+
+    @property
+    def background_waiting(self) -> int:
+        return len(self._background)
+
+    def _retry_after(self) -> float:
+        queued = self.waiting + self.background_waiting
+        return self._avg_hold * (queued + 1) / max(self.max_concurrent, 1)
+
+    @contextmanager
+    def slot(self, timeout: Optional[float] = None, bounded: bool = True):
+        """
+        Hold one LLM slot for the block. bounded=False waits without a queue limit or
+        timeout (background work that must eventually run), behind interactive waiters.
+        """
+        timeout = self.wait_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout if bounded else None
+        with self._cond:
+            if not bounded:
+                self._wait_background()
+            elif self.active >= self.max_concurrent:
+                if self.waiting >= self.max_waiting:
+                    raise Overloaded("LLM queue is full", self._retry_after())
+                self.waiting += 1
+                try:
+                    while self.active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise Overloaded("Timed out waiting for an LLM slot", self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    if not self.waiting and self._background:
+                        # background waiters were held back for us
+                        self._cond.notify_all()
+            self.active += 1
+
+        started = time.monotonic()
+        lease = None
+        try:
+            if self.leases is not None:
+                # the local slot is held meanwhile, so this worker's queue stays in order
+                lease = self.leases.acquire(deadline, self._retry_after)
+            yield
+        finally:
+            if lease is not None:
+                self.leases.release(lease)
+            held = time.monotonic() - started
+            with self._cond:
+                self.active -= 1
+                self._avg_hold = 0.8 * self._avg_hold + 0.2 * held
+                self._cond.notify_all()
+
+    def _wait_background(self):
+        # called with self._cond held
+        ticket = object()
+        self._background.append(ticket)
+        try:
+            while (self.active >= self.max_concurrent or self.waiting
+                   or self._background[0] is not ticket):
+                self._cond.wait()
+        finally:
+            self._background.remove(ticket)
+            if self._background:
+                # the next in line may fit too
+                self._cond.notify_all()
+
+llm_limiter = ConcurrencyLimiter(
+    LLM_MAX_CONCURRENCY, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT,
+    leases=GlobalLeases("llm:lease", LLM_GLOBAL_MAX_CONCURRENCY, LLM_LEASE_TTL) if LLM_GLOBAL_MAX_CONCURRENCY else None,
+)
+
+
+def take_user_token(user_id, burst: float = LLM_USER_BURST,
+                    refill_per_min: float = LLM_USER_REFILL_PER_MIN) -> Optional[float]:
+    """
+    Take one token from the user's bucket. Returns None if allowed, otherwise the
+    number of seconds until a token is available.
+    """
+    cache = get_cache()
+    key = f"bucket:llm:{user_id}"
+    rate = refill_per_min / 60.0
+    ttl = burst / rate if rate else None
+    for _ in range(5):
+        state = cache.get(key)
+        now = time.time()
+        if state is None:
+            tokens = burst
+        else:
+            tokens = min(burst, state["tokens"] + (now - state["ts"]) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate if rate else 60.0
+        if cache.compare_and_set(key, state, {"tokens": tokens - 1, "ts": now}, ttl=ttl):
+            return None
+    # lost the race repeatedly; someone else is spending this user's tokens
+    return 1.0
+
+def check_user_rate(user_id):
+    """Raise Overloaded if the user has used up their LLM budget."""
+    wait = take_user_token(user_id)
+    if wait is not None:
+        raise Overloaded("Too many plan generations; try again later", wait)
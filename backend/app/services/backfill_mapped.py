@@ -0,0 +1,179 @@
+"""
+Re-derive the mapped TypeformResponse columns from the stored answers JSONB, in SQL.
+
+    python -m app.services.backfill_mapped [--columns skills industry] [--batch-size 5000]
+    python -m app.services.backfill_mapped --verify-only --sample 10000
+
+The SQL is generated from REF_TO_COLUMN and mirrors extract_response_fields: the last
+answer whose ref maps to a column wins, and values are read according to the answer
+type. Rows are updated in primary-key ranges, one short transaction per range,
+and only rows whose values actually change are rewritten (cohort_counts is rebuilt
+afterwards if any did). --verify compares the SQL mapping with the Python mapper on
+a sample of stored rows.
+"""
+import time, argparse
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from sqlalchemy import text
+from ..db import engine
+from ..models import TypeformResponse
+from . import cohort_stats
+from .typeform_mapper import REF_TO_COLUMN, extract_response_fields
+
+MULTI_COLUMNS = ("skills", "career_challenges")
+# everything str.strip() removes (all of it is below U+3001), as an E'' literal for btrim
+WHITESPACE = "E'" + "".join(f"\\u{i:04x}" for i in range(0x3001) if chr(i).isspace()) + "'"
+FIRST_ID = "00000000-0000-0000-0000-000000000000"
+
+
+def mapped_columns() -> List[str]:
+    """Columns REF_TO_COLUMN fills that exist on typeform_responses."""
+    cols = []
+    for col in REF_TO_COLUMN.values():
+        if col not in cols and col in TypeformResponse.__table__.columns:
+            cols.append(col)
+    return cols
+
+def _last_answer(col: str, src: str) -> str:
+    refs = [ref for ref, c in REF_TO_COLUMN.items() if c == col]
+    cond = " || ".join(f'@.field.ref == "{ref}"' for ref in refs)
+    return f"jsonb_path_query_array({src}, '$[*] ? ({cond})') -> -1"
+
+def _scalar(a: str) -> str:
+    # _get_text / _get_choice / _get_number by answer type
+    text_val = f"COALESCE(NULLIF({a}->>'text', ''), NULLIF({a}->>'string', ''), {a}->>'email')"
+    return (f"CASE {a}->>'type' "
+            f"WHEN 'text' THEN {text_val} WHEN 'email' THEN {text_val} "
+            f"WHEN 'choice' THEN {a}->'choice'->>'label' "
+            f"WHEN 'number' THEN {a}->>'number' END")
+
+def _split(v: str) -> str:
+    # comma-split with each part stripped; NULL for blank input
+    return (f"(SELECT CASE WHEN btrim(v, {WHITESPACE}) <> '' THEN "
+            f"ARRAY(SELECT btrim(x, {WHITESPACE}) FROM unnest(string_to_array(v, ',')) "
+            f"WITH ORDINALITY AS p(x, i) ORDER BY p.i)::varchar[] END "
+            f"FROM (SELECT {v} AS v) s)")
+
+def _multi(a: str) -> str:
+    # list for "choices" answers (labels given as a string are comma-split),
+    # comma-split for scalar answers
+    labels = f"(COALESCE({a}->'choices', '{{}}'::jsonb)->'labels')"
+    labels_text = f"({labels} #>> '{{}}')"
+    return (f"CASE WHEN {a}->>'type' = 'choices' THEN "
+            f"CASE WHEN {labels} IS NULL THEN '{{}}'::varchar[] "
+            f"WHEN jsonb_typeof({labels}) = 'array' THEN ARRAY(SELECT jsonb_array_elements_text({labels}))::varchar[] "
+            f"WHEN jsonb_typeof({labels}) = 'string' THEN {_split(labels_text)} END "
+            f"WHEN {a}->>'type' IN ('text', 'email', 'choice') THEN {_split(_scalar(a))} END")
+
+def derived_columns(cols: Sequence[str], src: str = "t.answers", alias: str = "a") -> Tuple[str, str]:
+    """
+    Returns (lateral, select_list): a LATERAL join picking the last matching answer per
+    column out of `src` once, and the select list deriving each column from it.
+    """
+    lateral = ("CROSS JOIN LATERAL (SELECT "
+               + ", ".join(f"{_last_answer(c, src)} AS {c}" for c in cols)
+               + f") {alias}")
+    select_list = ",\n       ".join(
+        f"{_multi(f'{alias}.{c}') if c in MULTI_COLUMNS else _scalar(f'{alias}.{c}')} AS {c}"
+        for c in cols)
+    return lateral, select_list
+
+
+def _update_sql(cols: Sequence[str]) -> str:
+    lateral, derived = derived_columns(cols)
+    assign = ", ".join(f"{c} = d.{c}" for c in cols)
+    current = ", ".join(f"r.{c}" for c in cols)
+    new = ", ".join(f"d.{c}" for c in cols)
+    return f"""
+UPDATE typeform_responses r SET {assign}
+FROM (SELECT t.id,
+       {derived}
+      FROM typeform_responses t {lateral}
+      WHERE t.id > CAST(:lo AS uuid) AND t.id <= CAST(:hi AS uuid)) d
+WHERE r.id = d.id AND ROW({current}) IS DISTINCT FROM ROW({new})"""
+
+_RANGE_SQL = text("""
+SELECT id::text FROM (
+    SELECT id FROM typeform_responses WHERE id > CAST(:lo AS uuid) ORDER BY id LIMIT :n
+) t ORDER BY id DESC LIMIT 1""")
+
+
+def backfill(columns: Optional[Sequence[str]] = None, batch_size: int = 5000,
+             pause: float = 0.0) -> Dict[str, int]:
+    cols = list(columns or mapped_columns())
+    unknown = set(cols) - set(mapped_columns())
+    if unknown:
+        raise ValueError(f"Not mapped columns: {sorted(unknown)}")
+
+    update = text(_update_sql(cols))
+    stats = {"batches": 0, "updated": 0}
+    started = time.monotonic()
+    lo = FIRST_ID
+    while True:
+        with engine.begin() as conn:
+            hi = conn.execute(_RANGE_SQL, {"lo": lo, "n": batch_size}).scalar()
+            if hi is None:
+                break
+            stats["updated"] += conn.execute(update, {"lo": lo, "hi": hi}).rowcount
+        stats["batches"] += 1
+        lo = hi
+        if stats["batches"] % 20 == 0:
+            print(f"backfill: batches={stats['batches']} updated={stats['updated']} "
+                  f"({time.monotonic() - started:.1f}s)")
+        if pause:
+            time.sleep(pause)
+    print("backfill: done", stats)
+    if stats["updated"] and set(cols) & set(cohort_stats.DIMENSIONS):
+        cohort_stats.rebuild()
+    return stats
+
+
+def python_values(answers: List[Dict[str, Any]], cols: Sequence[str]) -> Dict[str, Any]:
+    """extract_response_fields for these columns, as the text/varchar[] values the SQL yields."""
+    expected = extract_response_fields(answers)
+    out = {}
+    for c in cols:
+        py = expected.get(c)
+        if c not in MULTI_COLUMNS and py is not None:
+            py = str(py)
+        out[c] = py
+    return out
+
+def verify(sample: int = 10000, columns: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+    """Compare the SQL mapping with extract_response_fields on stored rows; returns mismatches."""
+    cols = list(columns or mapped_columns())
+    lateral, derived = derived_columns(cols)
+    q = text(f"SELECT t.id::text AS id, t.answers, {derived} "
+             f"FROM typeform_responses t {lateral} ORDER BY t.id LIMIT :n")
+    mismatches = []
+    with engine.connect() as conn:
+        for row in conn.execute(q, {"n": sample}).mappings():
+            expected = python_values(row["answers"], cols)
+            for c in cols:
+                py = expected[c]
+                if py != row[c]:
+                    mismatches.append({"id": row["id"], "column": c, "python": py, "sql": row[c]})
+    print(f"verify: {len(mismatches)} mismatches")
+    for m in mismatches[:20]:
+        print("  ", m)
+    return mismatches
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Re-derive mapped typeform_responses columns from answers.")
+    ap.add_argument("--columns", nargs="*", help="only these columns (default: all mapped)")
+    ap.add_argument("--batch-size", type=int, default=5000, help="rows per primary-key range")
+    ap.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    ap.add_argument("--verify", action="store_true", help="check parity with the Python mapper first")
+    ap.add_argument("--verify-only", action="store_true", help="only run the parity check")
+    ap.add_argument("--sample", type=int, default=10000, help="rows to check with --verify")
+    args = ap.parse_args(argv)
+
+    if args.verify or args.verify_only:
+        if verify(args.sample, args.columns) and not args.verify_only:
+            raise SystemExit("verify: SQL mapping disagrees with extract_response_fields; not backfilling")
+        if args.verify_only:
+            return
+    backfill(args.columns, batch_size=args.batch_size, pause=args.pause)
+
+if __name__ == "__main__":
+    main()
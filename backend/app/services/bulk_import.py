@@ -0,0 +1,180 @@
+"""
+Bulk import of Typeform webhook payloads (historical backfills).
+
+    python -m app.services.bulk_import export.jsonl [more.jsonl sample.json ...]
+
+.jsonl files are streamed one payload per line; any other file is read as a single
+payload. Rows are COPY'd into a temp staging table in batches and merged into
+users / typeform_responses with set-based upserts, following the same rules as
+the webhook (last write wins per submission_id, user name only overwritten when
+present). No plan jobs are queued; cohort_counts is rebuilt once at the end.
+"""
+import io, json, time, argparse
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from ..db import engine
+from ..models import TypeformResponse
+from . import cohort_stats
+from .typeform_mapper import extract_response_fields, extract_name_email_from_answers, normalize_email
+
+MULTI_COLUMNS = ("skills", "career_challenges")
+# mapped columns that exist on the table, in a fixed order
+MAPPED_COLUMNS = [c for c in ("career_level", "career_goal", "industry", "target_role", "skills",
+                              "career_challenges", "coaching_style", "target_timeline",
+                              "study_time", "pressure_response")
+                  if hasattr(TypeformResponse, c)]
+STAGE_COLUMNS = ["seq", "submission_id", "form_id", "email", "name", "answers", "received_at"] + MAPPED_COLUMNS
+
+
+def parse_submission(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Map one webhook payload to a staging row, or None if it cannot be stored."""
+    frm = payload.get("form_response", {}) or {}
+    answers = frm.get("answers", []) or []
+    if isinstance(answers, str):
+        answers = json.loads(answers)
+    hidden = frm.get("hidden", {}) or {}
+    submission_id = payload.get("event_id") or frm.get("token")
+    form_id = frm.get("form_id")
+    if not submission_id or not form_id:
+        return None
+
+    who = extract_name_email_from_answers(answers) or {}
+    fields = extract_response_fields(answers) or {}
+    email = normalize_email(who.get("email") or fields.get("email") or hidden.get("email"))
+    name = who.get("name") or fields.get("name")
+
+    row = {
+        "submission_id": submission_id,
+        "form_id": form_id,
+        "email": email,
+        "name": name,
+        "answers": answers,
+        "received_at": frm.get("submitted_at") or frm.get("landed_at"),
+    }
+    for c in MAPPED_COLUMNS:
+        row[c] = fields.get(c)
+    return row
+
+def iter_payloads(path: str) -> Iterator[Dict[str, Any]]:
+    if not path.endswith(".jsonl"):
+        with open(path) as f:
+            yield json.load(f)
+        return
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"import: {path}:{n}: skipping invalid JSON ({e})")
+
+
+def _csv_value(v: Any) -> str:
+    # unquoted empty = NULL, everything else is quoted so "" stays an empty string
+    if v is None:
+        return ""
+    if isinstance(v, (list, dict)):
+        v = json.dumps(v)
+    return '"' + str(v).replace('"', '""') + '"'
+
+def _to_csv(rows: List[Dict[str, Any]]) -> io.StringIO:
+    buf = io.StringIO()
+    for r in rows:
+        buf.write(",".join(_csv_value(r.get(c)) for c in STAGE_COLUMNS))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
+
+
+def _array(col: str) -> str:
+    return f"CASE WHEN s.{col} IS NULL THEN NULL ELSE ARRAY(SELECT jsonb_array_elements_text(s.{col})) END"
+
+def _stage_ddl() -> str:
+    cols = ["seq bigint", "submission_id text", "form_id text", "email text", "name text",
+            "answers jsonb", "received_at timestamp"]
+    cols += [f"{c} {'jsonb' if c in MULTI_COLUMNS else 'text'}" for c in MAPPED_COLUMNS]
+    return f"CREATE TEMP TABLE import_stage ({', '.join(cols)}) ON COMMIT DROP"
+
+def _merge_sql() -> List[str]:
+    mapped_select = ", ".join(_array(c) if c in MULTI_COLUMNS else f"s.{c}" for c in MAPPED_COLUMNS)
+    mapped_update = ", ".join(f"{c} = EXCLUDED.{c}" for c in MAPPED_COLUMNS)
+    return [
+        # last payload wins for each submission
+        """CREATE TEMP TABLE import_latest ON COMMIT DROP AS
+           SELECT DISTINCT ON (submission_id) * FROM import_stage ORDER BY submission_id, seq DESC""",
+        """INSERT INTO users (email, name)
+           SELECT DISTINCT ON (email) email, name FROM import_stage
+           WHERE email IS NOT NULL
+           ORDER BY email, (name IS NULL), seq DESC
+           ON CONFLICT (email) DO UPDATE SET name = COALESCE(EXCLUDED.name, users.name)""",
+        f"""INSERT INTO typeform_responses
+               (user_id, form_id, submission_id, answers, received_at, {", ".join(MAPPED_COLUMNS)})
+           SELECT u.id, s.form_id, s.submission_id, s.answers, COALESCE(s.received_at, now()), {mapped_select}
+           FROM import_latest s LEFT JOIN users u ON u.email = s.email
+           ON CONFLICT (submission_id) DO UPDATE SET
+               user_id = COALESCE(EXCLUDED.user_id, typeform_responses.user_id),
+               form_id = EXCLUDED.form_id, answers = EXCLUDED.answers, {mapped_update}""",
+    ]
+
+
+def _load_batch(rows: List[Dict[str, Any]]):
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.execute(_stage_ddl())
+        cur.copy_expert(f"COPY import_stage ({', '.join(STAGE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                        _to_csv(rows))
+        for stmt in _merge_sql():
+            cur.execute(stmt)
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+
+def import_payloads(payloads: Iterable[Dict[str, Any]], batch_size: int = 50_000) -> Dict[str, int]:
+    stats = {"read": 0, "skipped": 0, "loaded": 0}
+    started = time.monotonic()
+    batch: List[Dict[str, Any]] = []
+
+    def flush():
+        _load_batch(batch)
+        stats["loaded"] += len(batch)
+        batch.clear()
+        elapsed = max(time.monotonic() - started, 1e-6)
+        print(f"import: loaded={stats['loaded']} skipped={stats['skipped']} "
+              f"({stats['loaded'] / elapsed:.0f} rows/s)")
+
+    for payload in payloads:
+        stats["read"] += 1
+        row = parse_submission(payload)
+        if row is None:
+            stats["skipped"] += 1
+            continue
+        row["seq"] = stats["read"]
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    if stats["loaded"]:
+        cohort_stats.rebuild()
+    return stats
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Bulk import Typeform webhook payloads.")
+    ap.add_argument("paths", nargs="+", help=".jsonl exports or single-payload .json files")
+    ap.add_argument("--batch-size", type=int, default=50_000, help="rows per COPY + merge")
+    args = ap.parse_args(argv)
+
+    def payloads():
+        for p in args.paths:
+            yield from iter_payloads(p)
+
+    print("import: done", import_payloads(payloads(), batch_size=args.batch_size))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""
+Offline bulk (re)generation of learning plans.
+
+    python -m app.services.bulk_regenerate --concurrency 8 --checkpoint regen.ckpt
+    python -m app.services.bulk_regenerate --checkpoint regen.ckpt --resume
+
+Streams every user's latest submission with a server-side cursor, skips users whose
+current plan already matches their signature and the run key (OPENAI_MODEL + prompt
+template, recorded in each plan as prompt_key) unless --force, generates the rest
+with bounded concurrency and inserts LearningPlan rows in bulk. Users whose prompts
+are identical share one generation; finished plans are kept in a bounded LRU so
+duplicates far apart in the stream still share.
+
+Completed (user, signature) pairs are appended to the checkpoint file. The file is
+stamped with the run key, and it is only read back with --resume and a matching key;
+otherwise it is started over.
+"""
+import os, time, random, argparse, threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Dict, List, Optional, Set
+from sqlalchemy import select, insert
+from openai import RateLimitError, APIStatusError
+from ..db import SessionLocal
+from ..models import User, TypeformResponse, LearningPlan
+from .plan_inputs import context_from, signature_for_context
+from .generate_plan import generate_learning_plan_with_usage, prompt_key, OPENAI_MODEL
+from .admission import llm_limiter
+
+# USD per 1K tokens, used only for the running cost estimate
+PRICE_IN_PER_1K = float(os.getenv("OPENAI_PRICE_IN_PER_1K", "0.0025"))
+PRICE_OUT_PER_1K = float(os.getenv("OPENAI_PRICE_OUT_PER_1K", "0.01"))
+
+# Fields that only identify the user; they are not part of the prompt, so two users
+# that differ only here get the same generated plan.
+IDENTITY_FIELDS = ("name", "email")
+
+
+def load_checkpoint(path: Optional[str], key: str) -> Set[str]:
+    """Done "user_id:signature" entries, or an empty set if the file is from another run."""
+    if not path or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        header = f.readline().strip()
+        if header != f"# run {key}":
+            print(f"bulk regen: checkpoint {path} is from a different model/prompt; ignoring it")
+            return set()
+        return {line.strip() for line in f if line.strip()}
+
+def start_checkpoint(path: str, key: str):
+    with open(path, "w") as f:
+        f.write(f"# run {key}\n")
+
+
+class RateGate:
+    """Paces requests to a requests-per-minute budget and pauses everyone after a 429."""
+
+    def __init__(self, rpm: int = 0):
+        self.interval = 60.0 / rpm if rpm else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+        self._paused_until = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next, self._paused_until)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def _retry_after(e: APIStatusError) -> Optional[float]:
+    try:
+        return float(e.response.headers.get("retry-after"))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class BulkRegenerator:
+    def __init__(self, *, concurrency: int = 8, batch_size: int = 500, insert_batch: int = 100,
+                 rpm: int = 0, max_retries: int = 6, force: bool = False,
+                 checkpoint: Optional[str] = None, resume: bool = False, limit: Optional[int] = None,
+                 share_cache: int = 2000, report_every: float = 10.0):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.insert_batch = insert_batch
+        self.max_retries = max_retries
+        self.force = force
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.limit = limit
+        self.share_cache = share_cache
+        self.report_every = report_every
+        self.gate = RateGate(rpm)
+        # this process only runs the batch; let every pool thread hold an LLM slot.
+        # LLM_GLOBAL_MAX_CONCURRENCY still caps it together with the web workers.
+        llm_limiter.configure(max_concurrent=concurrency)
+
+        self._lock = threading.Lock()
+        self._pending: List[Dict[str, Any]] = []
+        self._inflight: Dict[str, Future] = {}
+        # prompt key -> finished plan, least recently used first
+        self._finished: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._slots = threading.BoundedSemaphore(concurrency * 2)
+        self.stats = {"seen": 0, "skipped": 0, "generated": 0, "shared": 0, "failed": 0,
+                      "inserted": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        self._started = time.monotonic()
+        self._last_report = self._started
+
+    # --- source ---
+    def _eligible(self, db):
+        """Latest submission per user, streamed with a server-side cursor."""
+        stmt = (select(User, TypeformResponse)
+                .join(TypeformResponse, TypeformResponse.user_id == User.id)
+                .distinct(TypeformResponse.user_id)
+                .order_by(TypeformResponse.user_id, TypeformResponse.received_at.desc())
+                .execution_options(stream_results=True, yield_per=self.batch_size))
+        for user, resp in db.execute(stmt):
+            yield str(user.id), context_from(user, resp)
+
+    def _already_current(self, db, batch: List[Dict[str, Any]]) -> Set[str]:
+        if self.force or not batch:
+            return set()
+        rows = (db.query(LearningPlan.user_id, LearningPlan.input_signature)
+                  .filter(LearningPlan.user_id.in_([b["user_id"] for b in batch]),
+                          LearningPlan.input_signature.in_([b["sig"] for b in batch]),
+                          LearningPlan.plan["prompt_key"].astext == prompt_key())
+                  .all())
+        return {f"{uid}:{sig}" for uid, sig in rows}
+
+    # --- generation ---
+    def _generate(self, ctx: Dict[str, Any]) -> Dict[str, Any]:
+        for attempt in range(self.max_retries + 1):
+            self.gate.wait()
+            try:
+                plan, usage = generate_learning_plan_with_usage(ctx, background=True)
+            except (RateLimitError, APIStatusError) as e:
+                status = getattr(e, "status_code", None)
+                if attempt == self.max_retries or (status is not None and status != 429 and status < 500):
+                    raise
+                delay = _retry_after(e) or min(60.0, 2 ** attempt) + random.random()
+                print(f"bulk regen: rate limited/unavailable ({status}); backing off {delay:.1f}s")
+                self.gate.pause(delay)
+                continue
+            with self._lock:
+                self.stats["generated"] += 1
+                self.stats["prompt_tokens"] += usage["prompt_tokens"]
+                self.stats["completion_tokens"] += usage["completion_tokens"]
+            return plan
+
+    def _add_pending(self, item: Dict[str, Any], plan: Dict[str, Any]):
+        with self._lock:
+            self._pending.append({"user_id": item["user_id"], "input_signature": item["sig"],
+                                  "model": OPENAI_MODEL, "plan": plan})
+
+    def _submit(self, pool: ThreadPoolExecutor, item: Dict[str, Any]):
+        # identical prompts are generated once and shared
+        ctx = item["ctx"]
+        key = signature_for_context({k: v for k, v in ctx.items() if k not in IDENTITY_FIELDS})
+        with self._lock:
+            plan = self._finished.get(key)
+            if plan is not None:
+                self._finished.move_to_end(key)
+                self.stats["shared"] += 1
+        if plan is not None:
+            self._add_pending(item, plan)
+            return
+
+        # bounds the number of users waiting on a result
+        self._slots.acquire()
+        with self._lock:
+            fut = self._inflight.get(key)
+            created = fut is None
+            if created:
+                fut = pool.submit(self._generate, ctx)
+                self._inflight[key] = fut
+            else:
+                self.stats["shared"] += 1
+        if created:
+            # outside the lock: a finished future runs the callback right away.
+            # Waiters keep their own reference to the future.
+            fut.add_done_callback(lambda f: self._finish(key, f))
+
+        def done(f: Future):
+            self._slots.release()
+            try:
+                plan = f.result()
+            except Exception as e:
+                with self._lock:
+                    self.stats["failed"] += 1
+                print("bulk regen: failed for user", item["user_id"], e)
+                return
+            self._add_pending(item, plan)
+        fut.add_done_callback(done)
+
+    def _finish(self, key: str, fut: Future):
+        # move a finished plan from the in-flight map to the LRU; failures are retried
+        # by the next user with the same prompt
+        with self._lock:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+            if self.share_cache and not fut.exception():
+                self._finished[key] = fut.result()
+                self._finished.move_to_end(key)
+                while len(self._finished) > self.share_cache:
+                    self._finished.popitem(last=False)
+
+    # --- sink ---
+    def _flush(self, force: bool = False):
+        with self._lock:
+            if not self._pending or (not force and len(self._pending) < self.insert_batch):
+                return
+            rows, self._pending = self._pending, []
+        db = SessionLocal()
+        try:
+            db.execute(insert(LearningPlan), rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            with self._lock:
+                self._pending = rows + self._pending
+            raise
+        finally:
+            db.close()
+        if self.checkpoint:
+            with open(self.checkpoint, "a") as f:
+                f.write("".join(f"{r['user_id']}:{r['input_signature']}\n" for r in rows))
+                f.flush()
+                os.fsync(f.fileno())
+        with self._lock:
+            self.stats["inserted"] += len(rows)
+
+    def _report(self, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self._last_report < self.report_every:
+            return
+        self._last_report = now
+        s = self.stats
+        elapsed = max(now - self._started, 1e-6)
+        cost = (s["prompt_tokens"] / 1000 * PRICE_IN_PER_1K
+                + s["completion_tokens"] / 1000 * PRICE_OUT_PER_1K)
+        print(f"bulk regen: seen={s['seen']} skipped={s['skipped']} generated={s['generated']} "
+              f"shared={s['shared']} inserted={s['inserted']} failed={s['failed']} "
+              f"| {s['inserted'] / elapsed:.2f} plans/s, {s['generated'] * 60 / elapsed:.1f} LLM calls/min "
+              f"| tokens in={s['prompt_tokens']} out={s['completion_tokens']} ~${cost:.2f}")
+
+    def run(self) -> Dict[str, int]:
+        key = prompt_key()
+        done = load_checkpoint(self.checkpoint, key) if self.resume else set()
+        if done:
+            print(f"bulk regen: resuming run {key}, {len(done)} users already done")
+        elif self.checkpoint:
+            start_checkpoint(self.checkpoint, key)
+
+        src = SessionLocal()
+        lookup = SessionLocal()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                batch: List[Dict[str, Any]] = []
+
+                def drain():
+                    current = self._already_current(lookup, batch)
+                    lookup.rollback()
+                    for item in batch:
+                        if f"{item['user_id']}:{item['sig']}" in current:
+                            self.stats["skipped"] += 1
+                            continue
+                        self._submit(pool, item)
+                        self._flush()
+                        self._report()
+                    batch.clear()
+
+                for user_id, ctx in self._eligible(src):
+                    if self.limit is not None and self.stats["seen"] >= self.limit:
+                        break
+                    self.stats["seen"] += 1
+                    sig = signature_for_context(ctx)
+                    if f"{user_id}:{sig}" in done:
+                        self.stats["skipped"] += 1
+                        continue
+                    batch.append({"user_id": user_id, "ctx": ctx, "sig": sig})
+                    if len(batch) >= self.batch_size:
+                        drain()
+                drain()
+            self._flush(force=True)
+        finally:
+            src.close()
+            lookup.close()
+        self._report(final=True)
+        return dict(self.stats)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Regenerate learning plans for all eligible users.")
+    ap.add_argument("--concurrency", type=int, default=8, help="parallel LLM calls")
+    ap.add_argument("--rpm", type=int, default=0, help="max LLM requests per minute (0 = unpaced)")
+    ap.add_argument("--batch-size", type=int, default=500, help="users fetched per cursor batch")
+    ap.add_argument("--insert-batch", type=int, default=100, help="plans per bulk insert")
+    ap.add_argument("--checkpoint", default="bulk_regenerate.ckpt", help="file of completed users")
+    ap.add_argument("--resume", action="store_true",
+                    help="skip users done by an earlier run with the same model and prompt")
+    ap.add_argument("--force", action="store_true", help="regenerate even if the current plan matches")
+    ap.add_argument("--limit", type=int, default=None, help="stop after this many users")
+    ap.add_argument("--share-cache", type=int, default=2000,
+                    help="finished plans kept for users with identical prompts (0 = in-flight only)")
+    args = ap.parse_args(argv)
+
+    BulkRegenerator(concurrency=args.concurrency, rpm=args.rpm, batch_size=args.batch_size,
+                    insert_batch=args.insert_batch, checkpoint=args.checkpoint, resume=args.resume,
+                    force=args.force, limit=args.limit, share_cache=args.share_cache).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Cohort distributions (career_level, industry, target_role, skills, ...) across users.
+
+Each user counts once, by their current submission (latest received_at). The counts
+live in cohort_counts and are kept up to date incrementally: the webhook wraps its
+writes in track(), which locks the affected users, takes their current values before
+and after the change and applies the difference in the same transaction. Updating a
+submission that is no longer the user's latest changes nothing; a newer submission
+moves the user's counts from the old values to the new ones. Reading a distribution
+is an index range scan on cohort_counts, independent of the number of submissions.
+
+Bulk paths (bulk_import, backfill_mapped) call rebuild() instead, which recomputes
+everything in one set-based statement. init_db runs it when it creates cohort_counts,
+so a deployment that already has submissions starts from correct counts. It is also
+the repair tool:
+
+    python -m app.services.cohort_stats --rebuild
+"""
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List
+from sqlalchemy import text, select
+from sqlalchemy.orm import Session
+from ..db import engine
+from ..models import User
+
+SCALAR_DIMENSIONS = ("career_level", "industry", "target_role", "target_timeline")
+MULTI_DIMENSIONS = ("skills", "career_challenges")
+DIMENSIONS = SCALAR_DIMENSIONS + MULTI_DIMENSIONS
+# one row counting users with a submission, for percentages
+TOTAL = ("_users", "")
+
+_CURRENT_SQL = text(f"""
+SELECT DISTINCT ON (user_id) {', '.join(DIMENSIONS)}
+FROM typeform_responses
+WHERE user_id = ANY(:ids)
+ORDER BY user_id, received_at DESC, id DESC
+""")
+
+_UPSERT_SQL = text("""
+INSERT INTO cohort_counts (dimension, value, count) VALUES (:dimension, :value, :delta)
+ON CONFLICT (dimension, value) DO UPDATE SET count = cohort_counts.count + excluded.count
+""")
+
+
+def profile_counts(row: Any) -> Counter:
+    """(dimension, value) -> 1 for one submission (a mapping or a TypeformResponse row)."""
+    get = row.get if isinstance(row, dict) else (lambda k: getattr(row, k, None))
+    out = Counter([TOTAL])
+    for dim in SCALAR_DIMENSIONS:
+        v = get(dim)
+        if v:
+            out[(dim, v)] += 1
+    for dim in MULTI_DIMENSIONS:
+        for v in set(get(dim) or ()):
+            if v:
+                out[(dim, v)] += 1
+    return out
+
+def _current_counts(db: Session, user_ids: List[Any]) -> Counter:
+    total = Counter()
+    if user_ids:
+        for row in db.execute(_CURRENT_SQL, {"ids": user_ids}).mappings():
+            total.update(profile_counts(dict(row)))
+    return total
+
+def apply_delta(db: Session, delta: Counter):
+    """Add delta to cohort_counts inside the caller's transaction."""
+    params = [{"dimension": d, "value": v, "delta": n}
+              for (d, v), n in sorted(delta.items()) if n]
+    if params:
+        db.execute(_UPSERT_SQL, params)
+
+@contextmanager
+def track(db: Session, *user_ids):
+    """
+    Keep cohort_counts in step with submission writes made inside the block for
+    these users. The caller commits; the delta lands in the same transaction.
+    """
+    ids = sorted({u for u in user_ids if u}, key=str)
+    if ids:
+        # serialize concurrent submissions per user so both see the right "before"
+        db.execute(select(User.id).where(User.id.in_(ids)).order_by(User.id).with_for_update())
+    before = _current_counts(db, ids)
+    yield
+    db.flush()
+    delta = _current_counts(db, ids)
+    delta.subtract(before)
+    apply_delta(db, delta)
+
+
+def rebuild(conn=None):
+    """Recompute cohort_counts from typeform_responses in one transaction."""
+    unnest = " UNION ALL ".join(
+        [f"SELECT '{d}', {d} FROM cur WHERE {d} IS NOT NULL AND {d} <> ''" for d in SCALAR_DIMENSIONS]
+        # each distinct element once per user, like profile_counts
+        + [f"SELECT '{d}', u.v FROM cur, LATERAL (SELECT DISTINCT v FROM unnest(cur.{d}) AS v) u "
+           f"WHERE u.v IS NOT NULL AND u.v <> ''" for d in MULTI_DIMENSIONS]
+    )
+    sql = f"""
+    WITH cur AS (
+        SELECT DISTINCT ON (user_id) id, {', '.join(DIMENSIONS)}
+        FROM typeform_responses
+        WHERE user_id IS NOT NULL
+        ORDER BY user_id, received_at DESC, id DESC
+    )
+    INSERT INTO cohort_counts (dimension, value, count)
+    SELECT dimension, value, count(*) FROM (
+        SELECT '{TOTAL[0]}' AS dimension, '{TOTAL[1]}' AS value FROM cur
+        UNION ALL {unnest}
+    ) s
+    GROUP BY dimension, value
+    """
+    if conn is None:
+        with engine.begin() as c:
+            return rebuild(c)
+    # DELETE (not TRUNCATE) so readers keep seeing the old counts until commit
+    conn.execute(text("DELETE FROM cohort_counts"))
+    n = conn.execute(text(sql)).rowcount
+    print(f"cohort stats: rebuilt {n} rows")
+    return n
+
+
+def distribution(db: Session, dimension: str, limit: int = 50) -> Dict[str, Any]:
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"Unknown dimension: {dimension}")
+    rows = db.execute(text(
+        "SELECT value, count FROM cohort_counts WHERE dimension = :d AND count > 0 "
+        "ORDER BY count DESC, value LIMIT :limit"
+    ), {"d": dimension, "limit": limit}).all()
+    users = db.execute(text(
+        "SELECT count FROM cohort_counts WHERE dimension = :d AND value = :v"
+    ), {"d": TOTAL[0], "v": TOTAL[1]}).scalar() or 0
+    return {"dimension": dimension, "users": users,
+            "values": [{"value": v, "count": c} for v, c in rows]}
+
+def distributions(db: Session, dimensions: Iterable[str] = DIMENSIONS, limit: int = 50) -> Dict[str, Any]:
+    return {d: distribution(db, d, limit) for d in dimensions}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Maintain cohort_counts.")
+    ap.add_argument("--rebuild", action="store_true", help="recompute from typeform_responses")
+    args = ap.parse_args(argv)
+    if args.rebuild:
+        rebuild()
+    else:
+        ap.print_help()
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,34 @@
-import os, json
-from typing import Dict, Any, Optional
+import os, json, hashlib, threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, Optional, Tuple
 from sqlalchemy.orm import Session
-from openai import OpenAI
 from ..models import TypeformResponse, LearningPlan, User
-from app.db import SessionLocal
+from app.db import SessionLocal, pin_reads, release_connection
+from app.cache import get_cache
 from .plan_inputs import build_user_context, signature_for_context
+from .plan_index import find_reusable_plan, adapt_plan, PLAN_REUSE_MODE
+from .admission import llm_limiter
+from . import plan_events, plan_trace
 
 TEST_LLM = os.getenv("TEST_LLM", "").lower() in ("1", "true", "yes")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+PLAN_CACHE_TTL = int(os.getenv("PLAN_CACHE_TTL", "3600"))
+# how long a background job holds the claim on a (user, signature) pair
+PLAN_JOB_TTL = int(os.getenv("PLAN_JOB_TTL", "300"))
+# threads running plan jobs in this process, apart from the request threadpool
+PLAN_JOB_WORKERS = int(os.getenv("PLAN_JOB_WORKERS", "8"))
+_client = None
+_job_pool: Optional[ThreadPoolExecutor] = None
+_job_pool_lock = threading.Lock()
+
+def get_client():
+    """OpenAI client, built on first use so importing the app stays cheap."""
+    global _client
+    if _client is None:
+        from openai import OpenAI
+        _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
 
 SYSTEM = """You are an expert career coach and mentor who specializes in creating personalized, actionable career roadmaps for people in both tech and non-tech industries.
 
@@ -57,7 +77,7 @@ def _hours_from_study_time(st: Optional[str]) -> int:
             return 10
     return 10
 
-def build_prompt(profile: Dict[str, Any]) -> str:
+def build_prompt(profile: Dict[str, Any], seed_plan: Optional[Dict[str, Any]] = None) -> str:
     study_time = _hours_from_study_time(profile.get("study_time"))
     career_goal = profile.get("career_goal")
     career_level = profile.get("career_level")
@@ -70,7 +90,7 @@ def build_prompt(profile: Dict[str, Any]) -> str:
     tech_stack = profile.get("tech_stack")
     pressure_response = profile.get("pressure_response")
 
-    return f"""
+    prompt = f"""
 You are an expert career coach who creates personalized, actionable career roadmaps for individuals based on their unique goals, skills, and circumstances.
 
 User Profile:
@@ -113,14 +133,90 @@ VALIDATION RUBRIC (self-check before responding):
 - No empty arrays; all strings concise 
 - JSON parses as a single object 
 """
+    if seed_plan:
+        prompt += f"""
+Starting Point:
+A user with a very similar profile received the plan below. Use it as a draft and adapt it to this user's profile and constraints instead of starting from scratch.
+{json.dumps(seed_plan)}
+"""
+    return prompt
+
+@lru_cache(maxsize=1)
+def prompt_key() -> str:
+    """Identifies what a generation produces: the model and the prompt template."""
+    template = SYSTEM + build_prompt({})
+    return hashlib.sha256(f"{OPENAI_MODEL}\n{template}".encode()).hexdigest()[:16]
+
+def plan_for_context(db: Session, user_id, ctx: Dict[str, Any], allow_reuse: bool = True,
+                     background: bool = False) -> Tuple[Dict[str, Any], str]:
+    """
+    Returns (plan, model) for a context, reusing a near-identical user's plan when possible.
+    In "seed" mode the neighbour's plan is passed to the LLM as a draft instead.
+    The session's connection is released before any LLM call; it reconnects on next use.
+    background=True waits for an LLM slot instead of failing with Overloaded.
+    """
+    hit = find_reusable_plan(db, user_id, ctx) if allow_reuse else None
+    seed_plan = None
+    if hit:
+        source, similarity = hit
+        if PLAN_REUSE_MODE == "serve":
+            print(f"plan reuse: serving plan {source.id} (similarity={similarity:.3f})")
+            return adapt_plan(source.plan, ctx, source, similarity), source.model
+        seed_plan = source.plan
+    # don't hold a pooled connection through the LLM slot wait and call
+    release_connection(db)
+    return generate_learning_plan(ctx, seed_plan=seed_plan, background=background), OPENAI_MODEL
 
-def generate_plan_from_response(response_id, regenerate: bool = False):
+def find_existing_plan(db: Session, user_id, sig: str) -> Optional[Dict[str, Any]]:
+    """Latest plan for (user, signature) as {"model", "plan"}, served from the shared cache when possible."""
+    cache = get_cache()
+    key = f"plan:{user_id}:{sig}"
+    hit = cache.get(key)
+    if hit:
+        return hit
+    row = (db.query(LearningPlan)
+             .filter(LearningPlan.user_id == user_id,
+                     LearningPlan.input_signature == sig)
+             .order_by(LearningPlan.created_at.desc())
+             .first())
+    if not row:
+        return None
+    out = {"model": row.model, "plan": row.plan}
+    cache.set(key, out, ttl=PLAN_CACHE_TTL)
+    return out
+
+def remember_plan(user_id, sig: str, model: str, plan: Dict[str, Any]):
+    get_cache().set(f"plan:{user_id}:{sig}", {"model": model, "plan": plan}, ttl=PLAN_CACHE_TTL)
+
+def submit_plan_job(response_id, regenerate: bool = False, trace: Optional[plan_trace.Trace] = None) -> Future:
+    """
+    Run generate_plan_from_response on the plan job threads. Jobs can wait a long
+    time for an LLM slot, so they must not occupy the threads that serve requests;
+    jobs beyond PLAN_JOB_WORKERS queue in memory.
+    """
+    global _job_pool
+    if _job_pool is None:
+        with _job_pool_lock:
+            if _job_pool is None:
+                _job_pool = ThreadPoolExecutor(max_workers=PLAN_JOB_WORKERS, thread_name_prefix="plan-job")
+    return _job_pool.submit(generate_plan_from_response, response_id, regenerate=regenerate, trace=trace)
+
+def generate_plan_from_response(response_id, regenerate: bool = False, trace: Optional[plan_trace.Trace] = None):
+    # the webhook hands over its trace; jobs started elsewhere get their own
+    trace = trace or plan_trace.Trace()
+    trace.mark("job_started")
+    trace.response_id = response_id
+    trace_token = plan_trace.activate(trace)
     db = SessionLocal()
+    owner_id = None
     try:
         resp = db.query(TypeformResponse).filter(TypeformResponse.id == response_id).first()
         if not resp:
             print("plan job: no typeform response", response_id)
+            trace.outcome = "no_response"
             return
+        owner_id = trace.user_id = resp.user_id
+        plan_events.publish(owner_id, "started", response_id=response_id, trace_id=trace.trace_id)
 
         # Prefer resp.email if you store it; fallback to user.email if user_id exists
         email = getattr(resp, "email", None)
@@ -130,6 +226,7 @@ def generate_plan_from_response(response_id, regenerate: bool = False):
 
         if not email:
             print("plan job: missing email; cannot build context")
+            trace.outcome = "no_email"
             return
 
         # Build context using your existing logic
@@ -138,39 +235,78 @@ def generate_plan_from_response(response_id, regenerate: bool = False):
         ctx = built["context"]
 
         sig = signature_for_context(ctx)
+        trace.mark("context_built")
 
-        if not regenerate:
-            existing = (
-                db.query(LearningPlan)
-                .filter(LearningPlan.user_id == user_id,
-                        LearningPlan.input_signature == sig)
-                .order_by(LearningPlan.created_at.desc())
-                .first()
+        if not regenerate and find_existing_plan(db, user_id, sig):
+            print("plan job: deduped; existing plan returned")
+            trace.outcome = "deduped"
+            plan_events.publish(user_id, "ready", response_id=response_id, deduped=True,
+                                trace_id=trace.trace_id)
+            return
+
+        # only one worker generates a given (user, signature) at a time
+        job_key = f"plan:job:{user_id}:{sig}"
+        if not get_cache().add(job_key, 1, ttl=PLAN_JOB_TTL):
+            print("plan job: deduped; generation already in progress")
+            trace.outcome = "in_progress"
+            return
+        try:
+            # waits behind interactive callers rather than being rejected; the job must finish
+            plan, model = plan_for_context(db, user_id, ctx, allow_reuse=not regenerate, background=True)
+
+            row = LearningPlan(
+                user_id=user_id,
+                input_signature=sig,
+                model=model,
+                plan=plan
             )
-            if existing:
-                print("plan job: deduped; existing plan returned")
-                return
-
-        plan = generate_learning_plan(ctx)
-
-        row = LearningPlan(
-            user_id=user_id,
-            input_signature=sig,
-            model=OPENAI_MODEL,
-            plan=plan
-        )
-        db.add(row)
-        db.commit()
-        print("plan job: created plan for user", user_id)
+            db.add(row)
+            db.flush()
+            plan_id = row.id
+            db.commit()
+            trace.mark("plan_committed")
+            trace.outcome = "ready"
+            pin_reads(user_id, email)
+            remember_plan(user_id, sig, model, plan)
+            plan_events.publish(user_id, "ready", response_id=response_id, plan_id=plan_id,
+                                trace_id=trace.trace_id)
+            print("plan job: created plan for user", user_id)
+        finally:
+            get_cache().delete(job_key)
 
     except Exception as e:
         db.rollback()
         print("plan job failed:", e)
+        trace.outcome = "failed"
+        plan_events.publish(owner_id, "failed", response_id=response_id, error=type(e).__name__,
+                            trace_id=trace.trace_id)
         raise
     finally:
         db.close()
+        plan_trace.deactivate(trace_token)
+        trace.save()
 
-def generate_learning_plan(ctx: Dict[str, Any]) -> Dict[str, Any]:
+def generate_learning_plan(ctx: Dict[str, Any], seed_plan: Optional[Dict[str, Any]] = None,
+                           background: bool = False) -> Dict[str, Any]:
+    return generate_learning_plan_with_usage(ctx, seed_plan=seed_plan, background=background)[0]
+
+def generate_learning_plan_with_usage(ctx: Dict[str, Any], seed_plan: Optional[Dict[str, Any]] = None,
+                                      background: bool = False) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """
+    Same as generate_learning_plan, also returning the token usage of the call.
+    The plan records the prompt_key it was generated with.
+    """
+    # interactive callers get Overloaded when too many generations are running or queued;
+    # background jobs wait for a slot
+    with llm_limiter.slot(bounded=not background):
+        plan_trace.mark("llm_started")
+        plan, usage = _generate_learning_plan(ctx, seed_plan)
+        plan_trace.mark("llm_finished")
+    if isinstance(plan, dict):
+        plan["prompt_key"] = prompt_key()
+    return plan, usage
+
+def _generate_learning_plan(ctx: Dict[str, Any], seed_plan: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], Dict[str, int]]:
     print("PLAN JOB STARTED:")
     if TEST_LLM:
         # test model
@@ -182,13 +318,13 @@ def generate_learning_plan(ctx: Dict[str, Any]) -> Dict[str, Any]:
             ],
             "metrics": ["Problems/wk", "PRs", "Mocks"],
             "resources": [{"name": "Placeholder", "type": "doc", "url": "https://example.com"}],
-        }
+        }, {"prompt_tokens": 0, "completion_tokens": 0}
 
     """Generate and persist a learning plan using the latest Typeform response for this user."""
-    prompt = build_prompt(ctx)
+    prompt = build_prompt(ctx, seed_plan=seed_plan)
 
     # Call the model 
-    resp = client.chat.completions.create(
+    resp = get_client().chat.completions.create(
         model=OPENAI_MODEL,
         response_format={"type": "json_object"},
         messages=[
@@ -198,7 +334,11 @@ def generate_learning_plan(ctx: Dict[str, Any]) -> Dict[str, Any]:
         temperature=0.3,
     )
 
-    return json.loads(resp.choices[0].message.content)
+    usage = {
+        "prompt_tokens": getattr(resp.usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(resp.usage, "completion_tokens", 0) or 0,
+    }
+    return json.loads(resp.choices[0].message.content), usage
 
 # def latest_plan_by_email(db: Session, email: str) -> Optional[Dict[str, Any]]:
 #     lp = (db.query(LearningPlan)
@@ -0,0 +1,147 @@
+"""
+Plan readiness events ("queued" / "started" / "ready" / "failed") per user.
+
+publish() sends a Postgres NOTIFY on the plan_events channel, so every worker sees it.
+Each worker runs one listener thread on a dedicated connection (started with the
+first subscriber) and hands events to the asyncio queues of that user's open
+/plan/events streams. Events are not stored: a stream starts with one snapshot of
+the user's current status ("ready" / "pending" / "none"), taken after subscribing,
+so an event published before the client (re)connected is not lost. That is one
+query per connect; idle streams cost no database queries.
+"""
+import json, select, asyncio, threading, time
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Optional, Set
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+from ..db import engine
+
+CHANNEL = "plan_events"
+KEEPALIVE_SECONDS = 15
+# how long a new subscriber waits for the listener to be LISTENing before its snapshot
+LISTEN_READY_TIMEOUT = 5.0
+
+
+def publish(user_id, status: str, **data: Any):
+    """Best effort; a failed notify must never fail the caller."""
+    if not user_id:
+        return
+    payload = json.dumps({"user_id": str(user_id), "status": status, "at": time.time(), **data},
+                         default=str)
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_notify(:ch, :payload)"), {"ch": CHANNEL, "payload": payload})
+    except Exception as e:
+        print("plan events: publish failed:", e)
+
+
+class PlanEventHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._listening = threading.Event()
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen_forever, name="plan-events", daemon=True)
+                self._thread.start()
+
+    def _listen_forever(self):
+        backoff = 1.0
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                print(f"plan events: listener error ({e}); reconnecting in {backoff:.0f}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def _listen(self):
+        # dedicated connection, taken out of the pool for the life of the listener
+        raw = engine.raw_connection()
+        conn = raw.driver_connection
+        raw.detach()
+        try:
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {CHANNEL}")
+            self._listening.set()
+            print("plan events: listening")
+            while True:
+                # wakes only for notifications (or to notice a dead socket)
+                if select.select([conn], [], [], 60)[0]:
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+                else:
+                    conn.poll()
+        finally:
+            self._listening.clear()
+            conn.close()
+
+    def _dispatch(self, payload: str):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        with self._lock:
+            queues = list(self._subscribers.get(event.get("user_id"), ()))
+            loop = self._loop
+        for q in queues:
+            try:
+                loop.call_soon_threadsafe(_offer, q, event)
+            except RuntimeError:
+                pass  # event loop already closed
+
+    @asynccontextmanager
+    async def subscribe(self, user_id: str):
+        q: asyncio.Queue = asyncio.Queue(maxsize=100)
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            self._subscribers.setdefault(user_id, set()).add(q)
+        self._ensure_listener()
+        try:
+            if not self._listening.is_set():
+                await run_in_threadpool(self._listening.wait, LISTEN_READY_TIMEOUT)
+            yield q
+        finally:
+            with self._lock:
+                subs = self._subscribers.get(user_id)
+                if subs:
+                    subs.discard(q)
+                    if not subs:
+                        del self._subscribers[user_id]
+
+def _offer(q: asyncio.Queue, event: Dict[str, Any]):
+    try:
+        q.put_nowait(event)
+    except asyncio.QueueFull:
+        pass  # slow client; it will see the latest state on the next event
+
+hub = PlanEventHub()
+
+
+def _format(event: Dict[str, Any]) -> str:
+    return f"event: {event['status']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+async def event_stream(request, user_id: str, snapshot: Optional[Callable[[], Dict[str, Any]]] = None):
+    """
+    Server-sent events for one user, with keepalive comments while idle. snapshot()
+    (blocking, run in the threadpool) returns the current status, sent first.
+    """
+    async with hub.subscribe(user_id) as q:
+        yield "retry: 5000\n: subscribed\n\n"
+        if snapshot is not None:
+            yield _format({"user_id": user_id, "at": time.time(), "snapshot": True,
+                           **await run_in_threadpool(snapshot)})
+        while True:
+            try:
+                event = await asyncio.wait_for(q.get(), timeout=KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    return
+                yield ": keepalive\n\n"
+                continue
+            yield _format(event)
@@ -0,0 +1,306 @@
+"""
+Similarity-based plan reuse.
+
+Each worker keeps its own in-memory ProfileIndex. The webhook upserts into the index
+of the worker that received it only; other workers pick up submissions received
+since their last refresh every PLAN_INDEX_TTL seconds. The refresh reads only those
+rows and only the profile columns, in a background thread, so no request waits for
+it. Resubmissions that update an existing row keep their received_at and reach other
+workers only after a restart. A stale vector can only pick the wrong candidates:
+find_reusable_plan re-checks the neighbour's current profile and only serves a plan
+generated for it.
+"""
+import os, re, math, time, threading
+import datetime as dt
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from ..db import SessionLocal
+from ..models import TypeformResponse, LearningPlan
+from .plan_inputs import build_user_context, signature_for_context
+
+# Profile fields used for similarity. Single-choice fields are one-hot encoded,
+# multi-select fields are multi-hot encoded and scaled so the whole field weighs
+# the same as one single-choice field.
+CATEGORICAL_FIELDS = ("career_level", "industry", "target_role", "coaching_style",
+                      "target_timeline", "study_time", "pressure_response")
+MULTI_FIELDS = ("skills", "career_challenges")
+# Free-text inputs of the prompt that are not features; a plan is only served as-is
+# when these match exactly (after normalising case and whitespace).
+EXACT_FIELDS = ("career_goal", "tech_stack")
+
+PLAN_REUSE_THRESHOLD = float(os.getenv("PLAN_REUSE_THRESHOLD", "0.95"))
+# "serve" returns the neighbour's plan as-is, "seed" hands it to the LLM as a draft, "off" disables reuse
+PLAN_REUSE_MODE = os.getenv("PLAN_REUSE_MODE", "serve").lower()
+# seconds between refreshes of a worker's index from the database (0 = never)
+PLAN_INDEX_TTL = float(os.getenv("PLAN_INDEX_TTL", "300"))
+# a refresh re-reads this much before the newest row it has seen, for rows whose
+# transaction committed after a later-stamped one
+PLAN_INDEX_OVERLAP = dt.timedelta(seconds=60)
+
+
+def _norm(v: Any) -> Optional[str]:
+    if v is None:
+        return None
+    s = str(v).strip().lower()
+    return s or None
+
+def _norm_text(v: Any) -> Any:
+    if isinstance(v, (list, tuple)):
+        return sorted({_norm_text(x) for x in v} - {None}) or None
+    s = re.sub(r"\s+", " ", str(v)).strip().lower() if v is not None else ""
+    return s or None
+
+def same_exact_fields(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    """True when both profiles have the same EXACT_FIELDS."""
+    return all(_norm_text(a.get(f)) == _norm_text(b.get(f)) for f in EXACT_FIELDS)
+
+def profile_features(profile: Dict[str, Any]) -> Dict[str, float]:
+    """Encode a profile (context dict or mapped response fields) as sparse {feature: weight}."""
+    feats: Dict[str, float] = {}
+    for f in CATEGORICAL_FIELDS:
+        v = _norm(profile.get(f))
+        if v:
+            feats[f"{f}={v}"] = 1.0
+    for f in MULTI_FIELDS:
+        vals = {_norm(x) for x in (profile.get(f) or [])} - {None}
+        if vals:
+            w = 1.0 / math.sqrt(len(vals))
+            for v in vals:
+                feats[f"{f}={v}"] = w
+    return feats
+
+def similarity(a: Dict[str, Any], b: Dict[str, Any]) -> float:
+    """Cosine similarity of two profiles, same encoding as the index."""
+    fa, fb = profile_features(a), profile_features(b)
+    dot = sum(w * fb.get(name, 0.0) for name, w in fa.items())
+    na = math.sqrt(sum(w * w for w in fa.values()))
+    nb = math.sqrt(sum(w * w for w in fb.values()))
+    return dot / (na * nb) if na and nb else 0.0
+
+
+class ProfileIndex:
+    """
+    In-memory cosine index over user profiles (one row per user, latest submission wins).
+    Rows are L2-normalized so a top-k search is a single matrix-vector product.
+    NumPy is imported on first use to keep app import fast.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._lock = threading.Lock()
+        self._vocab: Dict[str, int] = {}
+        self._capacity = capacity
+        self._matrix = None
+        self._user_ids: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self.loaded = False
+        self.loaded_at = 0.0
+        # received_at of the newest submission seen by load() / refresh()
+        self.newest: Optional[dt.datetime] = None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _grow(self, rows: int, cols: int):
+        import numpy as np
+        if self._matrix is None:
+            self._matrix = np.zeros((self._capacity, 0), dtype=np.float32)
+        cap, width = self._matrix.shape
+        if rows <= cap and cols <= width:
+            return
+        new_cap = cap
+        while new_cap < rows:
+            new_cap *= 2
+        new_width = max(width, cols)
+        if cols > width:
+            new_width = max(cols, width + 64)
+        m = np.zeros((new_cap, new_width), dtype=np.float32)
+        m[:cap, :width] = self._matrix
+        self._matrix = m
+
+    def upsert(self, user_id, profile: Dict[str, Any]):
+        """Add or replace the profile row for a user."""
+        if not user_id:
+            return
+        import numpy as np
+        uid = str(user_id)
+        feats = profile_features(profile)
+        with self._lock:
+            for name in feats:
+                if name not in self._vocab:
+                    self._vocab[name] = len(self._vocab)
+            row = self._rows.get(uid)
+            if row is None:
+                row = len(self._user_ids)
+                self._user_ids.append(uid)
+                self._rows[uid] = row
+            self._grow(row + 1, len(self._vocab))
+
+            vec = np.zeros(self._matrix.shape[1], dtype=np.float32)
+            for name, w in feats.items():
+                vec[self._vocab[name]] = w
+            n = np.linalg.norm(vec)
+            self._matrix[row] = vec / n if n else vec
+
+    def remove(self, user_id):
+        with self._lock:
+            row = self._rows.pop(str(user_id), None)
+            if row is not None and self._matrix is not None:
+                self._matrix[row] = 0
+                self._user_ids[row] = None
+
+    def query(self, profile: Dict[str, Any], k: int = 5,
+              exclude_user_id=None) -> List[Tuple[str, float]]:
+        """Return up to k (user_id, cosine similarity) pairs, best first."""
+        import numpy as np
+        feats = profile_features(profile)
+        if not feats:
+            return []
+        with self._lock:
+            n = len(self._user_ids)
+            if n == 0:
+                return []
+            vec = np.zeros(self._matrix.shape[1], dtype=np.float32)
+            norm_sq = 0.0
+            for name, w in feats.items():
+                norm_sq += w * w
+                col = self._vocab.get(name)
+                if col is not None:
+                    vec[col] = w
+            # unseen features still count towards the query norm
+            scores = self._matrix[:n] @ (vec / np.sqrt(norm_sq))
+            user_ids = list(self._user_ids)
+            if exclude_user_id is not None:
+                row = self._rows.get(str(exclude_user_id))
+                if row is not None:
+                    scores[row] = -1.0
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(user_ids[i], float(scores[i])) for i in top
+                if user_ids[i] is not None and scores[i] > 0]
+
+    @staticmethod
+    def _profile_rows(db: Session, since: Optional[dt.datetime], batch_size: int):
+        """(user_id, received_at, profile) for submissions after `since`, oldest first."""
+        fields = CATEGORICAL_FIELDS + MULTI_FIELDS
+        q = (db.query(TypeformResponse.user_id, TypeformResponse.received_at,
+                      *[getattr(TypeformResponse, f) for f in fields])
+               .filter(TypeformResponse.user_id.isnot(None)))
+        if since is not None:
+            q = q.filter(TypeformResponse.received_at > since)
+        for row in q.order_by(TypeformResponse.received_at.asc()).yield_per(batch_size):
+            yield row[0], row[1], dict(zip(fields, row[2:]))
+
+    def load(self, db: Session, batch_size: int = 1000):
+        """
+        Build the index from all stored submissions, streaming oldest to newest.
+        Queries keep using the previous contents until the new ones are swapped in.
+        """
+        fresh = ProfileIndex(self._capacity)
+        newest = None
+        for user_id, received_at, profile in self._profile_rows(db, None, batch_size):
+            fresh.upsert(user_id, profile)
+            newest = received_at or newest
+        with self._lock:
+            self._vocab, self._matrix = fresh._vocab, fresh._matrix
+            self._user_ids, self._rows = fresh._user_ids, fresh._rows
+            self.newest = newest
+            self.loaded = True
+            self.loaded_at = time.monotonic()
+
+    def refresh(self, db: Session, batch_size: int = 1000) -> int:
+        """Upsert submissions received since the last load or refresh; returns how many."""
+        since = self.newest - PLAN_INDEX_OVERLAP if self.newest else None
+        n = 0
+        for user_id, received_at, profile in self._profile_rows(db, since, batch_size):
+            self.upsert(user_id, profile)
+            if received_at and (self.newest is None or received_at > self.newest):
+                self.newest = received_at
+            n += 1
+        self.loaded_at = time.monotonic()
+        return n
+
+
+profile_index = ProfileIndex()
+_load_lock = threading.Lock()
+
+def _stale() -> bool:
+    return PLAN_INDEX_TTL > 0 and time.monotonic() - profile_index.loaded_at > PLAN_INDEX_TTL
+
+def _refresh_in_background():
+    db = SessionLocal()
+    try:
+        n = profile_index.refresh(db)
+        if n:
+            print("plan index: refreshed", n, "profiles")
+    except Exception as e:
+        print("plan index: refresh failed:", e)
+    finally:
+        db.close()
+        _load_lock.release()
+
+def ensure_loaded(db: Session):
+    """
+    Load the index on first use. Once it is older than PLAN_INDEX_TTL, start a
+    background refresh and keep answering from the current contents meanwhile.
+    """
+    if not profile_index.loaded:
+        with _load_lock:
+            if not profile_index.loaded:
+                profile_index.load(db)
+                print("plan index: loaded", len(profile_index), "profiles")
+    elif _stale() and _load_lock.acquire(blocking=False):
+        if not _stale():
+            _load_lock.release()
+            return
+        try:
+            threading.Thread(target=_refresh_in_background, name="plan-index-refresh", daemon=True).start()
+        except Exception:
+            _load_lock.release()
+            raise
+
+
+def find_reusable_plan(db: Session, user_id, ctx: Dict[str, Any],
+                       k: int = 5) -> Optional[Tuple[LearningPlan, float]]:
+    """
+    Look for the most similar other user that already has a plan.
+    Returns (plan_row, similarity) when the similarity clears PLAN_REUSE_THRESHOLD.
+    The plan must have been generated for the neighbour's current profile, and the
+    similarity is recomputed against that profile, since the index may be stale.
+    In "serve" mode the EXACT_FIELDS must match too, as the plan is returned as-is.
+    """
+    if PLAN_REUSE_MODE == "off":
+        return None
+    ensure_loaded(db)
+    for neighbour_id, score in profile_index.query(ctx, k=k, exclude_user_id=user_id):
+        if score < PLAN_REUSE_THRESHOLD:
+            break
+        try:
+            current = build_user_context(db, user_id=neighbour_id)["context"]
+        except ValueError:
+            continue
+        score = similarity(ctx, current)
+        if score < PLAN_REUSE_THRESHOLD:
+            continue
+        if PLAN_REUSE_MODE == "serve" and not same_exact_fields(ctx, current):
+            continue
+        plan = (db.query(LearningPlan)
+                  .filter(LearningPlan.user_id == neighbour_id,
+                          LearningPlan.input_signature == signature_for_context(current))
+                  .order_by(LearningPlan.created_at.desc())
+                  .first())
+        if plan:
+            return plan, score
+    return None
+
+def adapt_plan(plan: Dict[str, Any], ctx: Dict[str, Any],
+               source: LearningPlan, similarity: float) -> Dict[str, Any]:
+    """Copy a neighbour's plan for this user and record where it came from."""
+    out = dict(plan)
+    out.pop("reused_from", None)
+    role = ctx.get("target_role")
+    summary = out.get("summary")
+    if role and isinstance(summary, str) and role.lower() not in summary.lower():
+        out["summary"] = f"{summary} (tailored for {role})"
+    out["reused_from"] = {"plan_id": str(source.id), "similarity": round(similarity, 4)}
+    return out
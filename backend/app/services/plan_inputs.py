@@ -33,7 +33,10 @@ def build_user_context(
     if not resp:
         raise ValueError("No Typeform submission found for this user")
 
-    ctx = {
+    return {"user_id": str(user.id), "context": context_from(user, resp)}
+
+def context_from(user: User, resp: TypeformResponse) -> Dict[str, Any]:
+    return {
         "name": user.name,
         "email": user.email,
         "career_level": getattr(resp, "career_level", None),
@@ -50,7 +53,6 @@ def build_user_context(
         "pressure_response": getattr(resp, "pressure_response", None),
       
     }
-    return {"user_id": str(user.id), "context": ctx}
 
 import json, hashlib
 def signature_for_context(ctx: Dict[str, Any]) -> str:
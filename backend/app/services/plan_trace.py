@@ -0,0 +1,109 @@
+"""
+End-to-end stage timing for plan generation.
+
+A Trace is started when the webhook arrives, handed to the background job, and
+marks each stage as it is reached:
+
+    received -> persisted -> queued -> job_started -> context_built
+             -> llm_started -> llm_finished -> plan_committed
+
+The job installs its trace as the current trace, so generate_learning_plan can mark
+the LLM stages without it being passed through every call. Marks are kept in memory
+and written as one plan_traces row when the job ends (best effort).
+
+stage_percentiles() reports p50/p90/p99 of the time spent between consecutive
+stages over a window, which shows whether queueing, the database or the LLM
+dominates.
+"""
+import uuid, contextvars
+import datetime as dt
+from typing import Any, Dict, List, Optional
+from sqlalchemy import insert, text
+from sqlalchemy.orm import Session
+from ..db import engine
+from ..models import PlanTrace
+
+STAGES = ("received", "persisted", "queued", "job_started", "context_built",
+          "llm_started", "llm_finished", "plan_committed")
+
+# segment name -> (from stage, to stage)
+SEGMENTS = {
+    "persist": ("received", "persisted"),
+    "enqueue": ("persisted", "queued"),
+    "queue_wait": ("queued", "job_started"),
+    "context": ("job_started", "context_built"),
+    "pre_llm": ("context_built", "llm_started"),   # dedupe, reuse lookup, LLM slot wait
+    "llm": ("llm_started", "llm_finished"),
+    "commit": ("llm_finished", "plan_committed"),
+    "total": ("received", "plan_committed"),
+}
+
+_current: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("plan_trace", default=None)
+
+
+class Trace:
+    def __init__(self, trace_id: Optional[uuid.UUID] = None):
+        self.trace_id = trace_id or uuid.uuid4()
+        self.marks: Dict[str, dt.datetime] = {}
+        self.response_id = None
+        self.user_id = None
+        self.outcome: Optional[str] = None
+
+    def mark(self, stage: str):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown trace stage: {stage}")
+        # first mark wins; retries inside a stage do not move it
+        self.marks.setdefault(stage, dt.datetime.now(dt.timezone.utc))
+
+    def save(self):
+        """Write the trace; never fails the caller."""
+        if not self.marks:
+            return
+        try:
+            with engine.begin() as conn:
+                conn.execute(insert(PlanTrace).values(
+                    trace_id=self.trace_id,
+                    response_id=self.response_id,
+                    user_id=self.user_id,
+                    outcome=self.outcome,
+                    **{f"{s}_at": self.marks.get(s) for s in STAGES},
+                ))
+        except Exception as e:
+            print("plan trace: save failed:", e)
+
+
+def activate(trace: Trace):
+    """Make trace the current one for this thread / task; returns a token for deactivate()."""
+    return _current.set(trace)
+
+def deactivate(token):
+    _current.reset(token)
+
+def mark(stage: str):
+    """Mark a stage on the current trace, if any."""
+    trace = _current.get()
+    if trace is not None:
+        trace.mark(stage)
+
+
+def stage_percentiles(db: Session, hours: float = 24.0) -> Dict[str, Any]:
+    """Per-segment p50/p90/p99 (seconds) and counts over traces started in the last `hours`."""
+    selects: List[str] = ["count(*) AS traces"]
+    for name, (a, b) in SEGMENTS.items():
+        d = f"extract(epoch FROM ({b}_at - {a}_at))"
+        selects.append(f"count({d}) AS {name}_n")
+        selects.append(f"percentile_cont(ARRAY[0.5, 0.9, 0.99]) WITHIN GROUP (ORDER BY {d}) AS {name}_p")
+    row = db.execute(text(
+        f"SELECT {', '.join(selects)} FROM plan_traces "
+        "WHERE coalesce(received_at, job_started_at) >= now() - make_interval(secs => :secs)"
+    ), {"secs": hours * 3600}).mappings().one()
+    outcomes = dict(db.execute(text(
+        "SELECT coalesce(outcome, 'unknown'), count(*) FROM plan_traces "
+        "WHERE coalesce(received_at, job_started_at) >= now() - make_interval(secs => :secs) GROUP BY 1"
+    ), {"secs": hours * 3600}).all())
+
+    stages = {}
+    for name in SEGMENTS:
+        p = row[f"{name}_p"] or [None, None, None]
+        stages[name] = {"count": row[f"{name}_n"], "p50": p[0], "p90": p[1], "p99": p[2]}
+    return {"window_hours": hours, "traces": row["traces"], "outcomes": outcomes, "stages": stages}
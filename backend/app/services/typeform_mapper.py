@@ -29,6 +29,31 @@ def _get_choices(a: Dict[str, Any]) -> List[str]:
 def _get_number(a: Dict[str, Any]) -> Optional[int]:
     return a.get("number")
 
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    if not email: 
+        return None
+    e = email.strip().lower()
+    return e or None
+
+def extract_name_email_from_answers(answers: List[Dict[str, Any]]) -> Dict[str, Optional[str]]:
+    name = None
+    email = None
+
+    for a in answers or []:
+        t = a.get("type")
+
+        if t == "email":
+            val = a.get("email")
+            if val:
+                email = val.strip()
+
+        if t == "text":
+            txt = (a.get("text") or "").strip()
+            if txt and not name:
+                name = txt
+
+    return {"name": name, "email": normalize_email(email)}
+
 def extract_response_fields(answers: List[Dict[str, Any]]) -> Dict[str, Any]:
     """
     Convert Typeform answers[] into a dict of columns for TypeformResponse.
@@ -0,0 +1,90 @@
+"""
+Import-time / startup budget check for the API.
+
+    python scripts/import_budget.py [--budget-ms 1500] [--startup-budget-ms 2000]
+
+Runs `python -X importtime -c "import app.main"` in a fresh interpreter, prints the
+slowest modules and fails (exit 1) if the cumulative import time of app.main exceeds
+the budget. Also times a fresh process up to the point FastAPI has run its startup
+handlers. Modules that must stay off the import path are checked as well.
+"""
+import os, sys, argparse, subprocess
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported lazily on first use; none of these should be loaded by `import app.main`
+LAZY_MODULES = ("openai", "google.oauth2", "httpx", "numpy")
+
+STARTUP_SNIPPET = """
+import time, asyncio
+t = time.perf_counter()
+import app.main
+async def run():
+    async with app.main.app.router.lifespan_context(app.main.app):
+        pass
+asyncio.run(run())
+print(time.perf_counter() - t)
+"""
+
+
+def _env():
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "postgresql+psycopg2://localhost/import_budget")
+    env["PYTHONPATH"] = BACKEND_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+def measure_imports():
+    """Returns ({module: (self_us, cumulative_us)}, loaded lazy modules)."""
+    code = ("import sys, app.main; "
+            f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))")
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=BACKEND_DIR, env=_env(), capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.exit(proc.stderr)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cum_us))
+    loaded = [m for m in proc.stdout.strip().split(",") if m]
+    return times, loaded
+
+def measure_startup() -> float:
+    proc = subprocess.run([sys.executable, "-c", STARTUP_SNIPPET],
+                          cwd=BACKEND_DIR, env=_env(), capture_output=True, text=True)
+    if proc.returncode != 0:
+        sys.exit(proc.stderr)
+    return float(proc.stdout.strip().splitlines()[-1]) * 1000
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "1500")))
+    ap.add_argument("--startup-budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", "2000")))
+    ap.add_argument("--top", type=int, default=10, help="slowest modules to show")
+    args = ap.parse_args(argv)
+
+    times, loaded = measure_imports()
+    total_ms = times.get("app.main", (0, 0))[1] / 1000
+    print(f"import app.main: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, (self_us, cum_us) in sorted(times.items(), key=lambda kv: -kv[1][0])[:args.top]:
+        print(f"  {self_us / 1000:8.1f} ms self {cum_us / 1000:8.1f} ms cumulative  {name}")
+
+    startup_ms = measure_startup()
+    print(f"process start to app ready: {startup_ms:.0f} ms (budget {args.startup_budget_ms:.0f} ms)")
+
+    failed = False
+    if loaded:
+        print("FAIL: imported eagerly but should be lazy:", ", ".join(loaded))
+        failed = True
+    if total_ms > args.budget_ms:
+        print("FAIL: import budget exceeded")
+        failed = True
+    if startup_ms > args.startup_budget_ms:
+        print("FAIL: startup budget exceeded")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""
+Run from backend/:  python -m pytest -q
+
+Tests that need Postgres use the `pg_engine` fixture and are skipped when DATABASE_URL
+is not set or the server is unreachable. Nothing here calls OpenAI (TEST_LLM=1).
+"""
+import os, sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TEST_LLM", "1")
+
+
+@pytest.fixture(scope="session")
+def pg_engine():
+    if not os.getenv("DATABASE_URL"):
+        pytest.skip("DATABASE_URL not set")
+    from sqlalchemy import text
+    from app.db import engine
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        pytest.skip(f"Postgres unavailable: {e}")
+    return engine
@@ -0,0 +1,119 @@
+"""ConcurrencyLimiter: interactive callers first, background callers in arrival order."""
+import time, threading
+import pytest
+from app.services.admission import ConcurrencyLimiter, Overloaded
+
+
+def hold(limiter, release: threading.Event, order: list, name: str, **kw):
+    with limiter.slot(**kw):
+        order.append(name)
+        release.wait()
+
+def wait_for(cond, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_background_waits_without_limit_and_in_order():
+    limiter = ConcurrencyLimiter(1, max_waiting=0, wait_timeout=0.1)
+    order, go = [], threading.Event()
+    go.set()
+    blocker = threading.Event()
+    first = threading.Thread(target=hold, args=(limiter, blocker, order, "first"))
+    first.start()
+    wait_for(lambda: limiter.active == 1)
+
+    threads = []
+    for i in range(20):
+        t = threading.Thread(target=hold, args=(limiter, go, order, f"bg{i}"), kwargs={"bounded": False})
+        t.start()
+        threads.append(t)
+        wait_for(lambda: limiter.background_waiting == i + 1)
+    with pytest.raises(Overloaded):  # interactive queue is full (max_waiting=0)
+        with limiter.slot():
+            pass
+
+    blocker.set()
+    for t in [first] + threads:
+        t.join(5)
+    assert order == ["first"] + [f"bg{i}" for i in range(20)]
+    assert limiter.active == 0 and limiter.background_waiting == 0
+
+@pytest.mark.parametrize("run", range(10))
+def test_interactive_waiter_goes_before_background(run):
+    limiter = ConcurrencyLimiter(1, max_waiting=4, wait_timeout=5)
+    order, go, blocker = [], threading.Event(), threading.Event()
+    go.set()
+    first = threading.Thread(target=hold, args=(limiter, blocker, order, "first"))
+    first.start()
+    wait_for(lambda: limiter.active == 1)
+    threads = [threading.Thread(target=hold, args=(limiter, go, order, f"bg{i}"), kwargs={"bounded": False})
+               for i in range(20)]
+    for t in threads:
+        t.start()
+    wait_for(lambda: limiter.background_waiting == 20)
+    interactive = threading.Thread(target=hold, args=(limiter, go, order, "interactive"))
+    interactive.start()
+    wait_for(lambda: limiter.waiting == 1)
+
+    blocker.set()
+    for t in [first, interactive] + threads:
+        t.join(5)
+    assert order[:2] == ["first", "interactive"]
+    assert len(order) == 22
+
+
+@pytest.fixture
+def shared_cache(monkeypatch):
+    from app.cache import MemoryCache
+    from app.services import admission
+    cache = MemoryCache()
+    monkeypatch.setattr(admission, "get_cache", lambda: cache)
+    return cache
+
+def test_global_leases_cap_across_workers(shared_cache):
+    from app.services.admission import GlobalLeases
+    # two "workers", each allowing 4 local calls, sharing 2 leases
+    workers = [ConcurrencyLimiter(4, 8, 5, leases=GlobalLeases("t:lease", 2, 60)) for _ in range(2)]
+    lock, running, peak = threading.Lock(), [0], [0]
+
+    def call(limiter):
+        with limiter.slot(bounded=False):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+    ts = [threading.Thread(target=call, args=(workers[i % 2],)) for i in range(12)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join(10)
+    assert peak[0] == 2
+    assert shared_cache.get("t:lease:0") is None and shared_cache.get("t:lease:1") is None
+
+def test_interactive_overloaded_when_leases_taken_elsewhere(shared_cache):
+    from app.services.admission import GlobalLeases
+    other = GlobalLeases("t:lease", 1, 60).try_acquire()
+    limiter = ConcurrencyLimiter(4, 8, 0.2, leases=GlobalLeases("t:lease", 1, 60))
+    with pytest.raises(Overloaded):
+        with limiter.slot():
+            pass
+    assert limiter.active == 0
+    GlobalLeases("t:lease", 1, 60).release(other)
+    with limiter.slot():
+        pass
+
+def test_expired_lease_is_not_released_by_old_holder(shared_cache):
+    from app.services.admission import GlobalLeases
+    leases = GlobalLeases("t:lease", 1, 0.1)
+    old = leases.try_acquire()
+    time.sleep(0.15)
+    new = leases.try_acquire()
+    assert new is not None
+    leases.release(old)
+    assert leases.try_acquire() is None
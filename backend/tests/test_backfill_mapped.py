@@ -0,0 +1,53 @@
+"""Parity between the SQL mapping in backfill_mapped and extract_response_fields."""
+import json
+import pytest
+from sqlalchemy import text
+
+
+def ans(ref, type_, **kw):
+    return {"field": {"ref": ref}, "type": type_, **kw}
+
+FIXTURES = {
+    "choices_null": [ans("skills", "choices", choices=None)],
+    "choices_empty_object": [ans("skills", "choices", choices={})],
+    "choices_missing": [ans("skills", "choices")],
+    "labels_null": [ans("skills", "choices", choices={"labels": None})],
+    "labels_list": [ans("skills", "choices", choices={"labels": ["Python", "SQL"]})],
+    "labels_empty_list": [ans("career_challenges", "choices", choices={"labels": []})],
+    "labels_string": [ans("skills", "choices", choices={"labels": "a, b ,c"})],
+    "labels_blank_string": [ans("skills", "choices", choices={"labels": "  "})],
+    "comma_text": [ans("skills", "text", text="Python, SQL,,  Go ")],
+    "comma_choice": [ans("career_challenges", "choice", choice={"label": "time,money"})],
+    "number_scalar": [ans("target_timeline", "number", number=12)],
+    "number_float": [ans("study_time", "number", number=7.5)],
+    "number_multi": [ans("skills", "number", number=3)],
+    "empty_text": [ans("industry", "text", text=""), ans("skills", "text", text="")],
+    "string_fallback": [ans("industry", "text", string="Finance")],
+    "email_type": [ans("career_goal", "email", email="x@example.com")],
+    "repeated_refs_last_wins": [ans("industry", "text", text="First"),
+                                ans("industry", "choice", choice={"label": "Second"}),
+                                ans("skills", "text", text="a,b"),
+                                ans("skills", "choices", choices={"labels": ["c"]})],
+    "repeated_ref_unknown_type_last": [ans("industry", "text", text="Kept?"),
+                                       ans("industry", "date", date="2024-01-01")],
+    "unicode_whitespace": [ans("skills", "text", text="a\u00a0, \u3000b ,\u2003c\u202f"),
+                           ans("career_challenges", "choices", choices={"labels": "x\u00a0,\u2009y"})],
+    "unicode_only_whitespace": [ans("skills", "text", text="\u00a0\u3000 ")],
+    "no_ref": [{"type": "text", "text": "orphan"}, ans("unmapped_ref", "text", text="ignored")],
+    "choice_without_label": [ans("career_level", "choice", choice={})],
+}
+
+
+@pytest.mark.parametrize("name", sorted(FIXTURES))
+def test_sql_mapping_matches_python(pg_engine, name):
+    from app.services.backfill_mapped import derived_columns, mapped_columns, python_values
+
+    answers = FIXTURES[name]
+    cols = mapped_columns()
+    lateral, derived = derived_columns(cols)
+    q = text(f"SELECT {derived} FROM (SELECT CAST(:answers AS jsonb) AS answers) t {lateral}")
+    with pg_engine.connect() as conn:
+        row = conn.execute(q, {"answers": json.dumps(answers)}).mappings().one()
+
+    expected = python_values(answers, cols)
+    assert {c: row[c] for c in cols} == expected
@@ -0,0 +1,119 @@
+"""Cache backends: memory://, a SQLite file, and Redis (fakeredis as the stand-in server)."""
+import time, threading
+import pytest
+from app.cache import MemoryCache, SQLiteCache, RedisCache
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def cache(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        return MemoryCache()
+    if request.param == "sqlite":
+        return SQLiteCache(str(tmp_path / "cache.db"))
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")  # fakeredis needs it to run the Lua scripts
+    import redis
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.Redis, "from_url",
+                        classmethod(lambda cls, url, **kw: fakeredis.FakeRedis(server=server, **kw)))
+    return RedisCache("redis://localhost:6379/0")
+
+
+def test_get_set_delete(cache):
+    assert cache.get("k") is None
+    cache.set("k", {"a": [1, 2], "b": "x"})
+    assert cache.get("k") == {"a": [1, 2], "b": "x"}
+    cache.set("k", 3)
+    assert cache.get("k") == 3
+    cache.delete("k")
+    assert cache.get("k") is None
+    cache.delete("missing")
+
+def test_ttl_expires(cache):
+    cache.set("short", 1, ttl=0.2)
+    cache.set("long", 1)
+    assert cache.get("short") == 1
+    time.sleep(0.35)
+    assert cache.get("short") is None
+    assert cache.get("long") == 1
+
+def test_incr(cache):
+    assert cache.incr("n") == 1
+    assert cache.incr("n", 5) == 6
+    assert cache.incr("n", -2) == 4
+    assert cache.get("n") == 4
+
+def test_incr_ttl_only_on_create(cache):
+    cache.incr("n", ttl=0.3)
+    time.sleep(0.15)
+    cache.incr("n", ttl=10)  # does not extend the existing expiry
+    time.sleep(0.25)
+    assert cache.get("n") is None
+
+def test_incr_concurrent(cache):
+    threads, per_thread = 8, 100
+
+    def work():
+        for _ in range(per_thread):
+            cache.incr("hits")
+
+    ts = [threading.Thread(target=work) for _ in range(threads)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    assert cache.get("hits") == threads * per_thread
+
+def test_compare_and_set(cache):
+    assert cache.compare_and_set("k", None, {"v": 1})
+    assert not cache.compare_and_set("k", None, {"v": 2})      # exists now
+    assert not cache.compare_and_set("k", {"v": 9}, {"v": 2})  # wrong expected value
+    assert cache.get("k") == {"v": 1}
+    assert cache.compare_and_set("k", {"v": 1}, {"v": 2})
+    assert cache.get("k") == {"v": 2}
+    cache.delete("k")
+    assert not cache.compare_and_set("k", {"v": 2}, {"v": 3})  # absent, expected a value
+
+def test_compare_and_set_ttl(cache):
+    assert cache.compare_and_set("k", None, 1, ttl=0.2)
+    time.sleep(0.35)
+    assert cache.get("k") is None
+    assert cache.add("k", 2)
+
+def test_delete_if(cache):
+    cache.set("lease", {"token": "a"})
+    assert not cache.delete_if("lease", {"token": "b"})
+    assert cache.get("lease") == {"token": "a"}
+    assert cache.delete_if("lease", {"token": "a"})
+    assert cache.get("lease") is None
+    assert not cache.delete_if("lease", {"token": "a"})
+
+def test_add(cache):
+    assert cache.add("once", 1, ttl=10)
+    assert not cache.add("once", 2)
+    assert cache.get("once") == 1
+
+def test_add_concurrent_single_winner(cache):
+    wins = []
+
+    def work(i):
+        if cache.add("claim", i):
+            wins.append(i)
+
+    ts = [threading.Thread(target=work, args=(i,)) for i in range(16)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    assert len(wins) == 1
+    assert cache.get("claim") == wins[0]
+
+def test_sqlite_purges_expired_keys_on_write(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.db"), purge_interval=0)
+    for i in range(20):
+        cache.add(f"webhook:{i}", 1, ttl=0.1)   # never read again
+    cache.set("keep", 1)
+    time.sleep(0.2)
+    cache.set("trigger", 1)
+    count = cache._conn().execute("SELECT count(*) FROM cache").fetchone()[0]
+    assert count == 2
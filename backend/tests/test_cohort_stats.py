@@ -0,0 +1,97 @@
+"""Incremental cohort_counts via track() against a full rebuild(), in a rolled-back transaction."""
+import uuid, datetime as dt
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+
+@pytest.fixture
+def db(pg_engine):
+    from app.services import cohort_stats
+    conn = pg_engine.connect()
+    tx = conn.begin()
+    session = Session(bind=conn, join_transaction_mode="create_savepoint")
+    cohort_stats.rebuild(conn)
+    try:
+        yield session
+    finally:
+        session.close()
+        tx.rollback()
+        conn.close()
+
+def counts(db):
+    rows = db.execute(text("SELECT dimension, value, count FROM cohort_counts WHERE count <> 0")).all()
+    return {(d, v): n for d, v, n in rows}
+
+def assert_matches_rebuild(db):
+    from app.services import cohort_stats
+    incremental = counts(db)
+    cohort_stats.rebuild(db.connection())
+    assert incremental == counts(db)
+    return incremental
+
+def make_user(db):
+    from app.models import User
+    user = User(email=f"cohort-{uuid.uuid4().hex[:8]}@example.com")
+    db.add(user)
+    db.flush()
+    return user
+
+def submit(db, user, received_at=None, **fields):
+    from app.models import TypeformResponse
+    from app.services.cohort_stats import track
+    resp = TypeformResponse(user_id=user.id, form_id="f", submission_id=uuid.uuid4().hex,
+                            answers=[], received_at=received_at, **fields)
+    with track(db, user.id):
+        db.add(resp)
+    return resp
+
+
+def test_new_submission_and_resubmission_update(db):
+    from app.services.cohort_stats import track, TOTAL
+    tag = uuid.uuid4().hex[:6]
+    before = counts(db)
+    user = make_user(db)
+    resp = submit(db, user, industry=f"fin-{tag}", skills=[f"py-{tag}", f"sql-{tag}", f"py-{tag}"])
+    after = assert_matches_rebuild(db)
+    assert after[TOTAL] == before.get(TOTAL, 0) + 1
+    assert after[("industry", f"fin-{tag}")] == 1
+    assert after[("skills", f"py-{tag}")] == 1   # once per user
+
+    with track(db, user.id):
+        resp.industry = f"health-{tag}"
+        resp.skills = [f"sql-{tag}"]
+    after = assert_matches_rebuild(db)
+    assert after[TOTAL] == before.get(TOTAL, 0) + 1
+    assert ("industry", f"fin-{tag}") not in after
+    assert after[("industry", f"health-{tag}")] == 1
+    assert ("skills", f"py-{tag}") not in after
+
+def test_owner_change(db):
+    from app.services.cohort_stats import track, TOTAL
+    tag = uuid.uuid4().hex[:6]
+    before = counts(db)
+    a, b = make_user(db), make_user(db)
+    resp = submit(db, a, industry=f"a-{tag}")
+    submit(db, b, received_at=dt.datetime(2000, 1, 1), industry=f"b-old-{tag}")
+    assert assert_matches_rebuild(db)[TOTAL] == before.get(TOTAL, 0) + 2
+
+    with track(db, a.id, b.id):
+        resp.user_id = b.id   # now b's latest; a has no submission left
+    after = assert_matches_rebuild(db)
+    assert after[TOTAL] == before.get(TOTAL, 0) + 1
+    assert after[("industry", f"a-{tag}")] == 1
+    assert ("industry", f"b-old-{tag}") not in after
+
+def test_update_of_non_latest_submission_changes_nothing(db):
+    from app.services.cohort_stats import track
+    tag = uuid.uuid4().hex[:6]
+    user = make_user(db)
+    old = submit(db, user, received_at=dt.datetime(2000, 1, 1), industry=f"old-{tag}")
+    submit(db, user, received_at=dt.datetime(2001, 1, 1), industry=f"new-{tag}")
+    before = assert_matches_rebuild(db)
+
+    with track(db, user.id):
+        old.industry = f"edited-{tag}"
+    assert assert_matches_rebuild(db) == before
+    assert ("industry", f"edited-{tag}") not in before
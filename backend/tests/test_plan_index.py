@@ -0,0 +1,49 @@
+"""ProfileIndex queries and the exact-match rule for serving a neighbour's plan."""
+import os, threading
+import pytest
+
+if not os.getenv("DATABASE_URL"):
+    pytest.skip("app.db needs DATABASE_URL", allow_module_level=True)
+
+from app.services.plan_index import ProfileIndex, same_exact_fields
+
+BASE = {"career_level": "Mid", "industry": "Software", "target_role": "Backend Engineer",
+        "skills": ["Python", "SQL"], "study_time": "10 hrs/week"}
+
+
+def test_query_excludes_the_asking_user():
+    index = ProfileIndex(capacity=4)
+    index.upsert("a", BASE)
+    index.upsert("b", BASE)
+    assert [u for u, _ in index.query(BASE, k=5, exclude_user_id="a")] == ["b"]
+
+def test_query_exclusion_under_concurrent_upserts():
+    index = ProfileIndex(capacity=2)
+    index.upsert("me", BASE)
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            index.upsert(f"u{i}", {**BASE, "industry": f"x{i}"})  # grows the matrix
+            i += 1
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        for _ in range(300):
+            assert "me" not in [u for u, _ in index.query(BASE, k=3, exclude_user_id="me")]
+    finally:
+        stop.set()
+        t.join()
+
+def test_exact_fields_normalised():
+    assert same_exact_fields({"career_goal": "Backend  SWE in 2 months", "tech_stack": ["Go", "python"]},
+                             {"career_goal": " backend swe in 2 MONTHS", "tech_stack": ["PYTHON", "go"]})
+    assert same_exact_fields({"career_goal": None, "tech_stack": []}, {})
+
+def test_exact_fields_differ():
+    assert not same_exact_fields({"career_goal": "Backend SWE in 2 months"},
+                                 {"career_goal": "Become a data scientist"})
+    assert not same_exact_fields({"career_goal": "x", "tech_stack": ["Go"]},
+                                 {"career_goal": "x", "tech_stack": ["Rust"]})
@@ -0,0 +1,125 @@
+"""
+get_read_db routing between the primary and a read replica.
+
+The replica is DATABASE_READ_URL when set (e.g. a second local database), otherwise a
+read-only engine on the primary's server; either way it is a separate engine.
+"""
+import os, time
+import jwt
+import pytest
+from sqlalchemy import text, exc as sa_exc
+from sqlalchemy.orm import sessionmaker
+from starlette.requests import Request
+
+
+def make_request(email=None, uid=None) -> Request:
+    headers = []
+    if uid:
+        token = jwt.encode({"uid": uid}, "routing-only-" + "x" * 32, algorithm="HS256")  # not verified
+        headers.append((b"cookie", f"session={token}".encode()))
+    query = f"email={email}".encode() if email else b""
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers, "query_string": query})
+
+def read_session(request):
+    from app import db as db_module
+    gen = db_module.get_read_db(request)
+    session = next(gen)
+    return session, gen
+
+
+@pytest.fixture
+def routing(pg_engine, monkeypatch):
+    from app import db as db_module
+    from app.cache import MemoryCache
+
+    url = os.getenv("DATABASE_READ_URL") or os.environ["DATABASE_URL"]
+    replica = db_module._make_engine(url, execution_options={"postgresql_readonly": True})
+    try:
+        with replica.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        pytest.skip(f"replica unavailable: {e}")
+    monkeypatch.setattr(db_module, "read_engine", replica)
+    monkeypatch.setattr(db_module, "ReadSessionLocal", sessionmaker(bind=replica))
+    cache = MemoryCache()
+    monkeypatch.setattr(db_module, "get_cache", lambda: cache)
+    monkeypatch.setattr(db_module, "READ_PIN_SECONDS", 1)
+    yield db_module, replica
+    replica.dispose()
+
+
+def test_reads_go_to_replica_by_default(routing):
+    db_module, replica = routing
+    session, gen = read_session(make_request(email="reader@example.com"))
+    try:
+        assert session.get_bind() is replica
+        session.execute(text("SELECT 1"))
+        with pytest.raises(sa_exc.InternalError):   # ReadOnlySqlTransaction
+            session.execute(text("CREATE TEMP TABLE rw_probe (x int)"))
+    finally:
+        gen.close()
+
+def test_pinned_by_email_reads_primary_then_expires(routing):
+    db_module, replica = routing
+    db_module.pin_reads("Writer@Example.com ")
+
+    session, gen = read_session(make_request(email="writer@example.com"))
+    try:
+        assert session.get_bind() is db_module.engine
+    finally:
+        gen.close()
+
+    # other users are not pinned
+    session, gen = read_session(make_request(email="someone-else@example.com"))
+    try:
+        assert session.get_bind() is replica
+    finally:
+        gen.close()
+
+    time.sleep(1.2)
+    session, gen = read_session(make_request(email="writer@example.com"))
+    try:
+        assert session.get_bind() is replica
+    finally:
+        gen.close()
+
+def test_pinned_by_session_uid(routing):
+    db_module, replica = routing
+    uid = "6b1f3c1e-0000-4000-8000-000000000001"
+    db_module.pin_reads(uid)
+    session, gen = read_session(make_request(uid=uid))
+    try:
+        assert session.get_bind() is db_module.engine
+    finally:
+        gen.close()
+
+def test_pinned_session_sees_its_own_write(routing):
+    db_module, replica = routing
+    from app.models import Ping
+
+    primary = db_module.SessionLocal()
+    try:
+        row = Ping(note="rw-test")
+        primary.add(row)
+        primary.commit()
+        pid = row.id
+    finally:
+        primary.close()
+    db_module.pin_reads("pinger@example.com")
+
+    session, gen = read_session(make_request(email="pinger@example.com"))
+    try:
+        assert session.get(Ping, pid) is not None
+    finally:
+        gen.close()
+        with db_module.engine.begin() as conn:
+            conn.execute(text("DELETE FROM ping WHERE id = :id"), {"id": pid})
+
+def test_no_replica_always_primary(pg_engine, monkeypatch):
+    from app import db as db_module
+    monkeypatch.setattr(db_module, "read_engine", db_module.engine)
+    session, gen = read_session(make_request(email="x@example.com"))
+    try:
+        assert session.get_bind() is db_module.engine
+    finally:
+        gen.close()